@@ -2,10 +2,14 @@ import socket
 import argparse
 import json
 import os
+import random
 import sys
 import signal
+import async_transfer
 import file_transfer as f_sys
-from threading import Thread, Event
+import protocol as proto
+import udp_tracker
+from threading import Thread, Event, Lock
 from time import sleep
 
 root_path = './storage'
@@ -16,6 +20,21 @@ this_port = None
 
 stop_server = Event()
 
+REGISTER_BATCH_SIZE = 1000  # Số file tối đa trong một message REGISTER_FILES
+ANNOUNCE_INTERVAL = 30      # Giây giữa 2 lần gửi heartbeat tới tracker
+NUMWANT = 50                # Số peer tối đa xin tracker cho mỗi file
+COMPACT_PEERS = True        # Xin tracker trả danh sách peer dạng binary (MSG_COMPACT)
+USE_UDP = False             # ANNOUNCE và tra cứu bằng magnet link qua UDP endpoint của tracker
+TRACKER_RETRIES = 5         # Số lần thử lại khi tracker trả RETRY_AFTER (quá tải)
+BACKOFF_CAP = 30            # Giây, trần của phần jitter khi thử lại
+TRANSFER_REPORT_INTERVAL = 10   # Giây giữa 2 lần gửi REPORT_TRANSFERS
+TRANSFER_BATCH_SIZE = 5000      # Số piece tối đa trong một message REPORT_TRANSFERS
+
+transfer_log = []           # [upload_ip, upload_port, info_hash, piece_index, bytes] chưa báo tracker
+transfer_lock = Lock()
+udp_client = None
+engine = None               # async_transfer.TransferEngine khi chạy với --engine asyncio
+
 #GETTERS
 def get_default_interface():
     """
@@ -48,6 +67,34 @@ def get_ephemeral_socket():
     client_socket.settimeout(10)
     return client_socket
 
+def backoff_delay(attempt, retry_after):
+    """
+    Seconds to wait before retry number `attempt` (0-based): what the tracker asked
+    for, plus a random share of an exponentially growing window. Nodes restarted
+    together then come back spread out instead of all at the same instant.
+    """
+    return retry_after + random.uniform(0, min(BACKOFF_CAP, retry_after * 2 ** attempt))
+
+def with_tracker(operation):
+    """
+    Run operation(sock) on a new tracker connection. If the tracker answers
+    RETRY_AFTER, close the connection, back off and run the operation again.
+    :param operation: Function taking the connected socket; its result is returned.
+    :raises proto.RetryAfter: If the tracker is still overloaded after TRACKER_RETRIES retries.
+    """
+    for attempt in range(TRACKER_RETRIES + 1):
+        ephemeral_socket = get_ephemeral_socket()
+        try:
+            return operation(ephemeral_socket)
+        except proto.RetryAfter as e:
+            if attempt == TRACKER_RETRIES:
+                raise
+            delay = backoff_delay(attempt, e.seconds)
+            print(f"{e}, trying again in {delay:.1f}s")
+        finally:
+            ephemeral_socket.close()
+        sleep(delay)
+
 # def get_ephemeral_socket(ip, port):
 #     """
 #     Establish a connection to the targeted peer using an ephemeral port.
@@ -74,22 +121,27 @@ def register_node(ephemeral_socket):
 
     try:
         request = f"REGISTER_NODE {this_ip} {this_port}"
-        ephemeral_socket.sendall(request.encode('utf-8'))
+        _, payload = proto.request(ephemeral_socket, request)
         print(f"Sent registration message: {request}")
 
-        respone = ephemeral_socket.recv(1024).decode("utf-8")
+        respone = proto.decode_text(payload)
         print(f"Server response: {respone}")
 
     except socket.error as e:
         print(f"Error sending registration message: {e}")
 
-def register_files(ephemeral_socket):
-    global root_path, this_ip, this_port
+def file_batches():
+    """
+    [file_name, total_piece, magnet_link] of every file in root_path, split into
+    lists of at most REGISTER_BATCH_SIZE files (one REGISTER_FILES message each).
+    """
+    global root_path
 
     if not os.path.exists(root_path):
         print(f"Storage path {root_path} does not exist.")
-        return
+        return []
 
+    entries = []
     for file_name in os.listdir(root_path):
         file_path = os.path.join(root_path, file_name)
         if os.path.isfile(file_path):
@@ -98,21 +150,43 @@ def register_files(ephemeral_socket):
                 
                 magnet_link = f_sys.generate_magnet_link(os.path.basename(file_path), pieces_metadata)
                 total_piece = len(pieces_metadata)
+                entries.append([file_name, total_piece, magnet_link])
+            except Exception as e:
+                print(f"Error registering file {file_name}: {e}")
 
-                request = f"REGISTER_FILE {this_ip} {this_port} {file_name} {total_piece} {magnet_link}"
+    return [entries[start:start + REGISTER_BATCH_SIZE] for start in range(0, len(entries), REGISTER_BATCH_SIZE)]
 
-                ephemeral_socket.sendall(request.encode('utf-8'))
-                print(f"Registered file: {file_name} with magnet link: {magnet_link}")
+def register_files():
+    """
+    Announce every file in root_path with REGISTER_FILES, REGISTER_BATCH_SIZE files
+    per message, instead of one REGISTER_FILE round-trip per file.
+    The files are hashed once; a batch the tracker throttles (RETRY_AFTER) is sent
+    again on its own, the batches already accepted are not.
+    """
+    for batch in file_batches():
+        with_tracker(lambda ephemeral_socket: send_file_batch(ephemeral_socket, batch))
 
-                respone = ephemeral_socket.recv(1024).decode('utf-8')
-                print(f"Server response: {respone}")
-                
-            except Exception as e:
-                print(f"Error registering file {file_name}: {e}")
+def send_file_batch(ephemeral_socket, batch):
+    """
+    Send one REGISTER_FILES message: the command line, then the JSON list of
+    [file_name, total_piece, magnet_link] on the following line.
+    """
+    request = f"REGISTER_FILES {this_ip} {this_port}\n" + json.dumps(batch)
+    try:
+        msg_type, payload = proto.request(ephemeral_socket, request)
+        print(f"Registered {len(batch)} files in one batch.")
+
+        respone = proto.decode_text(payload)
+        if msg_type == proto.MSG_JSON:
+            respone = json.loads(respone)["message"]
+        print(f"Server response: {respone}")
+    except proto.RetryAfter:
+        raise   # Để with_tracker chờ rồi gửi lại batch này
+    except Exception as e:
+        print(f"Error registering batch of {len(batch)} files: {e}")
 
 def register_one_file(file_name):
     global root_path, this_ip, this_port
-    ephemeral_socket = get_ephemeral_socket()
 
     file_path = os.path.join(root_path, file_name)
     if os.path.isfile(file_path):
@@ -124,64 +198,259 @@ def register_one_file(file_name):
 
             request = f"REGISTER_FILE {this_ip} {this_port} {file_name} {total_piece} {magnet_link}"
 
-            ephemeral_socket.sendall(request.encode('utf-8'))
+            _, payload = with_tracker(lambda ephemeral_socket: proto.request(ephemeral_socket, request))
             print(f"Registered file: {file_name} with magnet link: {magnet_link}")
 
-            respone = ephemeral_socket.recv(1024).decode('utf-8')
+            respone = proto.decode_text(payload)
             print(f"Server response: {respone}")
             
         except Exception as e:
             print(f"Error registering file {file_name}: {e}")
 
 def connect_to_tracker():
-    ephemeral_socket = get_ephemeral_socket()
-
-    try:        
-        register_node(ephemeral_socket)
-        register_files(ephemeral_socket)
+    try:
+        # Nhiều node khởi động cùng lúc: tracker có thể trả RETRY_AFTER, with_tracker lo việc chờ
+        with_tracker(register_node)
+        register_files()
 
     except Exception as e:
         print(f"Error connecting to tracker: {e}")
 
-    finally:
-        if ephemeral_socket:
-            ephemeral_socket.close()
+def announce_loop():
+    """
+    Send ANNOUNCE to the tracker every ANNOUNCE_INTERVAL seconds so it keeps this
+    node in its swarms. If the tracker has forgotten the node (expired or tracker
+    restarted), register the node and its files again.
+    """
+    global this_ip, this_port
+
+    while not stop_server.wait(ANNOUNCE_INTERVAL):
+        if USE_UDP and udp_announce():
+            continue
+
+        try:
+            if not with_tracker(announce):
+                # Đăng ký lại ngoài with_tracker(announce): RETRY_AFTER giữa chừng không gửi lại từ đầu
+                with_tracker(register_node)
+                register_files()
+        except Exception as e:
+            print(f"Error sending announce: {e}")
+
+def announce(ephemeral_socket):
+    """
+    One TCP heartbeat.
+    :return: False if the tracker forgot this node and it must register again.
+    """
+    msg_type, payload = proto.request(ephemeral_socket, f"ANNOUNCE {this_ip} {this_port}")
+    if msg_type == proto.MSG_ERROR:
+        print(f"Tracker response to ANNOUNCE: {proto.decode_text(payload)} Registering again...")
+        return False
+    return True
+
+def get_udp_client():
+    global udp_client
+    if udp_client is None:
+        udp_client = udp_tracker.UdpTrackerClient(tracker_ip, tracker_port)
+    return udp_client
+
+def udp_announce():
+    """
+    Send one ANNOUNCE datagram instead of opening a TCP connection.
+    :return: True if the tracker acknowledged it. False if the announce must go
+        over TCP: no reply (UDP disabled on the tracker, packet loss) or the
+        tracker no longer knows this node and it has to register again.
+    """
+    try:
+        get_udp_client().announce(this_ip, this_port)
+        return True
+    except udp_tracker.TrackerError as e:
+        print(f"Tracker response to UDP ANNOUNCE: {e}")
+    except (OSError, TimeoutError) as e:
+        print(f"UDP announce failed, falling back to TCP: {e}")
+    return False
+
+def udp_find_magnet(magnet_link):
+    """
+    Resolve a magnet link with one UDP LOOKUP.
+    :return: Swarm dict like the FIND_FILE reply, None if nobody has the file.
+    """
+    magnet = f_sys.decode_magnet_link(magnet_link)
+    try:
+        swarm_info = get_udp_client().lookup(magnet["info_hash"], NUMWANT)
+    except udp_tracker.TrackerError as e:
+        print(f"Tracker response to UDP LOOKUP: {e}")
+        return None
+    swarm_info.update(file_name=magnet["file_name"], info_hash=magnet["info_hash"], magnet_link=magnet_link)
+    return swarm_info
+
+def report_pieces(info_hash, total_piece, piece_indices):
+    """
+    Tell the tracker which pieces of a file this node already holds while it is
+    still downloading it (HAVE_PIECES), so other nodes can fetch them from here.
+    The file is identified by its info_hash, file names are not unique.
+    """
+    global this_ip, this_port
+
+    if not piece_indices:
+        return
+    bitfield = proto.make_bitfield(piece_indices, total_piece)
+    request = f"HAVE_PIECES {this_ip} {this_port} {info_hash} {proto.encode_bitfield(bitfield)}"
+
+    try:
+        msg_type, payload = with_tracker(lambda ephemeral_socket: proto.request(ephemeral_socket, request))
+        if msg_type == proto.MSG_ERROR:
+            print(f"Tracker response to HAVE_PIECES: {proto.decode_text(payload)}")
+    except Exception as e:
+        print(f"Error reporting pieces of {info_hash}: {e}")
+
+def withdraw_pieces(info_hash, total_piece):
+    """
+    Take back the pieces reported with report_pieces() after the download failed
+    and its data was deleted: HAVE_PIECES with an all-zero bitfield.
+    """
+    bitfield = proto.make_bitfield([], total_piece)
+    request = f"HAVE_PIECES {this_ip} {this_port} {info_hash} {proto.encode_bitfield(bitfield)}"
+
+    try:
+        msg_type, payload = with_tracker(lambda ephemeral_socket: proto.request(ephemeral_socket, request))
+        if msg_type == proto.MSG_ERROR:
+            print(f"Tracker response to HAVE_PIECES: {proto.decode_text(payload)}")
+    except Exception as e:
+        print(f"Error withdrawing pieces of {info_hash}: {e}")
+
+def record_transfer(info_hash, piece_index, peer_ip, peer_port, size):
+    """
+    Remember one downloaded piece; report_transfers() sends it to the tracker later.
+    """
+    with transfer_lock:
+        transfer_log.append([peer_ip, peer_port, info_hash, piece_index, size])
+
+def report_transfers():
+    """
+    Send every transfer logged since the last report, TRANSFER_BATCH_SIZE per
+    REPORT_TRANSFERS message. Transfers that could not be sent are kept for the next report.
+    """
+    global this_ip, this_port
+
+    with transfer_lock:
+        pending = transfer_log[:]
+        transfer_log.clear()
+
+    for start in range(0, len(pending), TRANSFER_BATCH_SIZE):
+        batch = pending[start:start + TRANSFER_BATCH_SIZE]
+        request = f"REPORT_TRANSFERS {this_ip} {this_port}\n" + json.dumps(batch)
+        try:
+            with_tracker(lambda ephemeral_socket: proto.request(ephemeral_socket, request))
+        except Exception as e:
+            print(f"Error reporting {len(pending) - start} transfers: {e}")
+            with transfer_lock:
+                transfer_log[:0] = pending[start:]
+            return
+
+def report_loop():
+    """
+    Report completed piece transfers every TRANSFER_REPORT_INTERVAL seconds,
+    in batches instead of one tracker write per piece.
+    """
+    while not stop_server.wait(TRANSFER_REPORT_INTERVAL):
+        report_transfers()
+
+def find_options():
+    """
+    Options appended to FIND_FILE / FIND_FILES requests.
+    """
+    options = f"numwant={NUMWANT}"
+    if COMPACT_PEERS:
+        options += " compact=1"
+    return options
 
 '''
 Thread-related functions
 '''
-def download_file(file_name):
+def find_files(file_names):
+    """
+    Look up several files in one FIND_FILES round-trip to the tracker.
+    :param file_names: File names, info_hashes or magnet links.
+    :return: dict key -> {"nodes", "file_name", "info_hash", "magnet_link", "total_piece", "bitfields"},
+        None for files nobody has.
+    """
+    request = "FIND_FILES " + " ".join(file_names) + " " + find_options()
+    msg_type, payload = with_tracker(lambda client_socket: proto.request(client_socket, request))
+    print(f"Sent request: {request}")
+    return f_sys.parse_find_files_reply(msg_type, payload)
+
+def download_from_swarm(file_name, swarm_info):
+    """
+    Download a file whose swarm is already known, then announce it to the tracker.
+    :param file_name: Key the file was looked up with (name, info_hash or magnet link).
+    :param swarm_info: One entry of the FIND_FILE / FIND_FILES reply.
+    """
     global root_path
 
     try:
-        client_socket = get_ephemeral_socket()
-        request = f"FIND_FILE {file_name}"
+        file_name = swarm_info.get('file_name') or file_name     # Tra bằng info_hash/magnet -> lấy tên thật
+        nodes = swarm_info['nodes']                  #Array of [ip, port], eg: [["192.168.56.104", 1100], ["192.168.56.106", 1100]]
+        magnet_link = swarm_info['magnet_link']      #String
+        total_piece = swarm_info['total_piece']      #Int
+        info_hash = f_sys.decode_magnet_link(magnet_link)["info_hash"]
+        bitfields = {peer: proto.decode_bitfield(bitfield)
+                     for peer, bitfield in swarm_info.get('bitfields', {}).items()}
+
+        reported = []
+        def on_progress(piece_indices):
+            # Chỉ báo tracker khi có piece mới
+            if len(piece_indices) > len(reported):
+                reported[:] = piece_indices
+                report_pieces(info_hash, total_piece, piece_indices)
+
+        def on_piece(piece_index, peer_ip, peer_port, size):
+            record_transfer(info_hash, piece_index, peer_ip, peer_port, size)
+
+        success = False
+        try:
+            success = f_sys.download_file(file_name, nodes, magnet_link, total_piece, root_path,
+                                          bitfields=bitfields, on_progress=on_progress, on_piece=on_piece, engine=engine)
+        finally:
+            # Tải lỗi hoặc file hỏng đã bị xóa: tracker không được quảng bá các piece đã báo nữa
+            if not success and reported:
+                withdraw_pieces(info_hash, total_piece)
 
-        client_socket.sendall(request.encode('utf-8'))
-        print(f"Sent request: {request}")
+        #Declare new file to the tracker
+        if success:
+            register_one_file(file_name)
 
-        response = client_socket.recv(1024 * 20).decode('utf-8')
-        respones_json = f_sys.parse_find_file_response(response)
-        print('JSON object retrived')
+    except Exception as e:
+        print(f"Error downloading file {file_name}: {e}")
 
-        f_sys.inscpect(respones_json)
+def download_file(file_name):
+    global root_path
 
-        client_socket.close()  #Close for other connections
+    if USE_UDP and file_name.startswith("magnet:"):
+        try:
+            swarm_info = udp_find_magnet(file_name)
+            if swarm_info:
+                download_from_swarm(file_name, swarm_info)
+            return
+        except (OSError, TimeoutError) as e:
+            print(f"UDP lookup failed, falling back to TCP: {e}")
 
-        nodes = respones_json['nodes']                  #Array of [ip, port], eg: [["192.168.56.104", 1100], ["192.168.56.106", 1100]]
-        magnet_link = respones_json['magnet_link']      #String
-        total_piece = respones_json['total_piece']      #Int
+    try:
+        request = f"FIND_FILE {file_name} {find_options()}"
 
-        success = f_sys.download_file(file_name, nodes, magnet_link, total_piece, root_path)
+        # with_tracker đóng connection trước khi tải, nhường chỗ cho connection khác
+        msg_type, payload = with_tracker(lambda client_socket: proto.request(client_socket, request))
+        print(f"Sent request: {request}")
+        respones_json = f_sys.parse_find_reply(msg_type, payload)
+        if not respones_json:
+            return
+        print('JSON object retrived')
 
-        #Declare new file to the tracker
-        if success:
-            register_one_file(file_name)
+        f_sys.inscpect(respones_json)
+
+        download_from_swarm(file_name, respones_json)
 
     except Exception as e:
         print(f"Error processing REQUEST_FILE command: {e}")
-    finally:
-        client_socket.close()
 
 def start_server_process(this_ip, this_port):   #terminated
     """
@@ -201,10 +470,9 @@ def start_server_process(this_ip, this_port):   #terminated
             client_socket, client_addr = server_socket.accept()
             print(f"Accepted connection from {client_addr}")
 
-            # Handle the client connection in a separate thread
-            client_thread = Thread(target=handle_income_request, args=(client_socket,))
+            # Handle the client connection in a separate thread (không join: peer giữ connection suốt lượt tải)
+            client_thread = Thread(target=handle_income_request, args=(client_socket,), daemon=True)
             client_thread.start()
-            client_thread.join()
     except Exception as e:
         print(f"Error in server process: {e}")
     finally:
@@ -212,26 +480,43 @@ def start_server_process(this_ip, this_port):   #terminated
 
 def handle_income_request(client_conn):
     """
-    Handle the communication with a connected client.
+    Handle the communication with a connected client. A downloading peer keeps
+    the connection for all its pieces and pipelines REQUEST_PIECE (see
+    file_transfer.PeerSession); they are answered back-to-back, in order.
     :param client_conn: The socket object for the client connection.
     """
     global stop_server
     global root_path
+    buffer = bytearray(4096)    # Lệnh từ peer rất ngắn, dùng lại buffer cho cả connection
+    client_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     try:
         while not stop_server.is_set():
-            data = client_conn.recv(1024).decode("utf-8").strip()
-            if not data:
+            msg_type, payload = proto.recv_frame(client_conn, buffer)
+            if msg_type is None:
                 print("Client disconnected.")
                 break
+            if msg_type != proto.MSG_COMMAND:
+                proto.send_error(client_conn, "Expected a command.")
+                continue
+
+            data = proto.decode_text(payload).strip()
 
             print(f"Received from client: {data}") # Có thể bỏ
             if data.startswith("REQUEST_PIECE"):
                 '''
-                REQUEST_PIECE <file_name> <piece_index>
+                REQUEST_PIECE <file_name> <piece_index> [<piece_size>]
                 '''
-                _, file_name, piece_index = data.split()
-                f_sys.upload_piece(root_path, client_conn, file_name, int(piece_index))
-
+                try:
+                    _, file_name, piece_index, *piece_size = data.split()
+                    piece_index = int(piece_index)
+                    piece_size = int(piece_size[0]) if piece_size else None    # Node cũ không gửi piece_size
+                except ValueError:
+                    # Vẫn phải trả lời: peer pipeline chờ reply theo đúng thứ tự request
+                    proto.send_error(client_conn, "Malformed command.")
+                    continue
+                f_sys.upload_piece(root_path, client_conn, file_name, piece_index, piece_size)
+            else:
+                proto.send_error(client_conn, "Unknown command.")
 
     except Exception as e:
         print(f"Error handling client: {e}")
@@ -254,59 +539,28 @@ def handle_cli_input(this_ip, this_port):
 
             elif command.startswith("FIND_FILE"):       
                 '''
-                FIND_FILE <file_name>
+                FIND_FILE <file_name | info_hash | magnet_link> [numwant=<n>] [compact=1]
                 '''         
                 try:
-                    client_socket = get_ephemeral_socket()
-                    _, file_name = command.split()
+                    file_name = command.split()[1]
                     request = command
-                    client_socket.sendall(request.encode('utf-8'))
+                    msg_type, payload = with_tracker(lambda client_socket: proto.request(client_socket, request))
                     print(f"Sent request: {request}")
-
-                    response = client_socket.recv(1024 * 20).decode('utf-8')
-                    respone_json = f_sys.parse_find_file_response(response)
+                    respone_json = f_sys.parse_find_reply(msg_type, payload)
+                    if not respone_json:
+                        continue
                     print(f"Server response: ")
                     f_sys.inscpect(respone_json)
 
                 except Exception as e:
                     print(f"Error processing FIND_FILE command: {e}")
-                finally:
-                      client_socket.close()
 
             elif command.startswith("REQUEST_FILE"):
                 '''
-                REQUEST_FILE <file_name>
+                REQUEST_FILE <file_name | info_hash | magnet_link>
                 '''    
-                try:
-                    client_socket = get_ephemeral_socket()
-                    _, file_name = command.split()
-                    request = f"FIND_FILE {file_name}"
-
-                    client_socket.sendall(request.encode('utf-8'))
-                    print(f"Sent request: {request}")
-
-                    response = client_socket.recv(1024 * 20).decode('utf-8')
-                    respones_json = f_sys.parse_find_file_response(response)
-                    print('JSON object retrived')
-
-                    client_socket.close() #Close for other connections  
-
-                    f_sys.inscpect(respones_json)
-
-                    nodes = respones_json['nodes']                  #Array of [ip, port], eg: [["192.168.56.104", 1100], ["192.168.56.106", 1100]]
-                    magnet_link = respones_json['magnet_link']      #String
-                    total_piece = respones_json['total_piece']      #Int
-
-                    success = f_sys.download_file(file_name, nodes, magnet_link, total_piece, root_path)
-
-                    #Declare new file to the tracker
-                    if success:
-                        register_one_file(file_name)
-
-                except Exception as e:
-                    print(f"Error processing REQUEST_FILE command: {e}")
-                finally:
-                    client_socket.close()
+                _, file_name = command.split()
+                download_file(file_name)     # Magnet link + --udp: tra cứu bằng một datagram
 
             elif command.startswith("REQUEST_MUL"):
                 '''
@@ -315,9 +569,15 @@ def handle_cli_input(this_ip, this_port):
                 _, thread_num, *files = command.split()
                 thread_num = int(thread_num)
 
+                # Một request FIND_FILES cho cả danh sách thay vì một FIND_FILE mỗi file
+                swarms = find_files(files)
+
                 threads = []
                 for file_name in files:
-                    thread = Thread(target=download_file, args=(file_name,))
+                    if not swarms.get(file_name):
+                        print(f"No nodes have the requested file {file_name}.")
+                        continue
+                    thread = Thread(target=download_from_swarm, args=(file_name, swarms[file_name]))
                     threads.append(thread)
 
                 for thread in threads:
@@ -344,14 +604,14 @@ def cleaning_up(sig, frame):
     stop_server.set()
     print("Interrupt received, shutting down...")
 
-    ephemeral_socket = get_ephemeral_socket()
+    report_transfers()  # Gửi nốt các transfer chưa báo
     # Send disconnect message to the tracker
     try:
         REQUEST = f"DISCONNECT_NODE {this_ip} {this_port}"
-        ephemeral_socket.sendall(REQUEST.encode('utf-8'))
+        _, payload = with_tracker(lambda ephemeral_socket: proto.request(ephemeral_socket, REQUEST))
         print(f"Sent disconnect message: {REQUEST}")
 
-        RESPONSE = ephemeral_socket.recv(1024).decode('utf-8')
+        RESPONSE = proto.decode_text(payload)
         print(f"Server response: {RESPONSE}")
 
         sys.exit(0)
@@ -359,9 +619,6 @@ def cleaning_up(sig, frame):
     except Exception as e:
         print(f"Error sending disconnect message: {e}")
 
-    finally:
-        ephemeral_socket.close()
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         prog="Client",
@@ -371,6 +628,11 @@ if __name__ == "__main__":
     # parser.add_argument("--server-ip", required=True, help="IP address of the server.")
     # parser.add_argument("--server-port", type=int, required=True, help="Port of the server.")
     parser.add_argument("--root-folder", required=True, help="Root folder.")
+    parser.add_argument("--announce-interval", type=float, default=ANNOUNCE_INTERVAL, help="Seconds between heartbeats to the tracker.")
+    parser.add_argument("--udp", action="store_true", help="Announce and resolve magnet links over the tracker's UDP endpoint.")
+    parser.add_argument("--pipeline-window", type=int, default=f_sys.PIPELINE_WINDOW, help="Piece requests in flight per peer (one connection per peer).")
+    parser.add_argument("--download-workers", type=int, default=f_sys.DOWNLOAD_WORKERS, help="Worker threads per download, i.e. peers downloaded from in parallel.")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads", help="Serve and download pieces with a thread per connection, or on one asyncio event loop.")
 
     args = parser.parse_args()
 
@@ -391,6 +653,19 @@ if __name__ == "__main__":
     assign_global(tracker_ip, tracker_port, args.root_folder, pserver_ip, pserver_port)
     connect_to_tracker()
 
+    ANNOUNCE_INTERVAL = args.announce_interval
+    USE_UDP = args.udp
+    f_sys.PIPELINE_WINDOW = args.pipeline_window
+    f_sys.DOWNLOAD_WORKERS = args.download_workers
+    if args.engine == "asyncio":
+        # Khởi động trước CLI để mọi lệnh REQUEST_FILE/REQUEST_MUL đều chạy trên engine
+        engine = async_transfer.TransferEngine(root_path)
+        engine.start(pserver_ip, pserver_port)
+    announce_thread = Thread(target=announce_loop, daemon=True)
+    announce_thread.start()
+    report_thread = Thread(target=report_loop, daemon=True)
+    report_thread.start()
+
     # server_thread = Thread(target=start_server_process, daemon=False, args=(pserver_ip, pserver_port))
     CLI_thread = Thread(target=handle_cli_input, daemon=True, args=(pserver_ip, pserver_port))
 
@@ -404,6 +679,13 @@ if __name__ == "__main__":
     # server_thread.join()
     # CLI_thread.join()
 
+    if args.engine == "asyncio":
+        # Upload và download chạy trên event loop của engine; main thread chỉ chờ tín hiệu dừng
+        while not stop_server.wait(1):
+            pass
+        engine.stop()
+        sys.exit(0)
+
     #Try this model! the server model as the main thread, and the CLI as the sub-thread (daemon)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.bind((pserver_ip, pserver_port))
@@ -414,9 +696,9 @@ if __name__ == "__main__":
     while True:
         print("Waiting for connection...")
         conn, addr = server_socket.accept()      #Lệnh này mang tính blocking, chờ kết nối từ client
-        node_thread = Thread(target=handle_income_request, args=(conn,))
+        # Không join: mỗi peer giữ một connection lâu dài, join sẽ chặn các peer khác
+        node_thread = Thread(target=handle_income_request, args=(conn,), daemon=True)
         node_thread.start()
-        node_thread.join()
         
 
     cleaning_up(None, None)
@@ -4,15 +4,51 @@ import json
 import sys
 import hashlib
 import signal
+import argparse
+import time
+import multiprocessing
+import select
+import selectors
 
-from threading import Thread, Event
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock, local
 from init_db import *
 import db_manager as db
+import protocol as proto
+import swarm
+import stats
+import shard
+import udp_tracker
+import admission
 
 #Global
 server_socket = None
 stop_event = Event()
 
+# Concurrency settings (có thể đổi qua command line)
+MAX_WORKERS = 64            # Số thread xử lý request cùng lúc
+MAX_CONNECTIONS = 1024      # Số connection được mở cùng lúc (kể cả đang rảnh, không giữ worker)
+IDLE_TIMEOUT = 30           # Giây, connection không gửi gì sẽ bị đóng
+MAX_QUEUED = 256            # Số request đã nhận nhưng còn chờ worker tối đa
+FOLLOW_UP_REQUESTS = 16     # Số request liên tiếp của một connection worker trả lời trước khi trả connection về selector
+FOLLOW_UP_WAIT = 0.005      # Giây worker chờ request tiếp theo của connection vừa trả lời
+RETRY_AFTER = 2.0           # Giây gợi ý cho node khi hàng đợi hoặc số connection đã đầy
+
+executor = None
+request_buffers = local()
+returned_clients = deque()  # Connection worker đã trả lời xong, chờ selector theo dõi lại
+wakeup_socket = None
+open_connections = 0
+active_connections = 0
+queued_connections = 0
+rejected_connections = 0
+active_lock = Lock()
+
+# Lệnh được thống kê riêng; lệnh lạ gộp vào "UNKNOWN" để số key không tăng vô hạn
+COMMANDS = {"REGISTER_NODE", "ANNOUNCE", "REGISTER_FILES", "REGISTER_FILE", "HAVE_PIECES",
+            "FIND_FILES", "FIND_FILE", "DISCONNECT", "DISCONNECT_NODE", "REPORT_TRANSFERS", "ANALYTICS"}
+
 #Lấy IP của máy đang chạy, nếu fail thì lấy IP mặc định = '192.168.56.105'
 def get_host_default_interface_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -25,65 +61,395 @@ def get_host_default_interface_ip():
        s.close()
     return ip
 
-def start_tracker_process(conn, addr):
-    client_ip = None
-    client_port = None
-    
+class Client:
+    """
+    A node connection and what is kept about it between two of its requests.
+    """
+
+    def __init__(self, conn, addr, routed=True):
+        self.conn = conn
+        self.addr = addr
+        self.routed = routed
+        self.paid = routed                  # Lệnh đầu tiên dùng token connection đã trả lúc accept
+        self.last_active = time.monotonic()
+
+def request_buffer():
+    # Buffer nhận lệnh của worker thread hiện tại, dùng lại cho mọi request nó xử lý
+    buffer = getattr(request_buffers, "buffer", None)
+    if buffer is None:
+        buffer = request_buffers.buffer = bytearray(64 * 1024)
+    return buffer
+
+def start_tracker_process(conn, addr, routed=True):
+    """
+    Request loop of one connection on its own thread, for connections coming
+    from another shard (see shard.py). Node connections go through
+    serve_connections() instead.
+
+    Args:
+        routed (bool): In multi-process mode, send commands about swarms owned by
+            other shards to those shards. False for connections coming from
+            another shard, which are always handled locally.
+    """
+    client = Client(conn, addr, routed)
     try:
-        while True:
-            data = conn.recv(1024).decode("utf-8").strip()
-            if not data:  # Nếu không có dữ liệu, ngắt kết nối
-                print(f"Connection closed by {addr}")
-                break
+        while serve_request(client):
+            pass
+    finally:
+        conn.close()
 
-            print(f"Received from {addr}: {data}")
-
-            # Phân tích và xử lý yêu cầu
-            if data.startswith("REGISTER_NODE"):
-                _, client_ip, client_port = data.split()
-                db.register_node(client_ip, client_port)
-                conn.sendall("Node registered!".encode('utf-8'))
-
-            elif data.startswith("REGISTER_FILE"):
-                '''
-                input REGISTTER_FILE <node_ip> <node_port> <file_name> <total_piece> <magnet_link>
-                output: message from the DB
-                '''
-
-                _, client_ip, client_port, file_name, total_piece, magnet_link = data.split()                
-                response = db.register_file(file_name, int(total_piece), client_ip, client_port, magnet_link)
-                conn.sendall(response.encode('utf-8'))
-
-            elif data.startswith("FIND_FILE"):
-                '''
-                input FIND_FILE  <file_name>
-                output: message from the DB
-                '''
-                _, file_name = data.split()
-                response = db.get_nodes_has_file(file_name)
-                
-                # Debug: Print the response from the database
-                print(f"Response from the db for file '{file_name}': {response}")
-                
-                response_json = {
-                    "nodes": response["nodes"],
-                    "magnet_link": response["magnet_link"],
-                    "total_piece": response["total_piece"]
-                }
-                
-                conn.sendall(json.dumps(response_json).encode('utf-8'))
-
-            elif data.startswith("DISCONNECT"):
-                _, client_ip, client_port = data.split()
-                db.remove_node(client_ip, client_port)
-                conn.sendall("Node disconnected.".encode('utf-8'))
+def serve_request(client):
+    """
+    Read and answer one request of a connection.
 
-            else:
-                conn.sendall("Unknown command.".encode('utf-8'))
+    Returns:
+        bool: True if the connection stays open for more requests.
+    """
+    conn, addr = client.conn, client.addr
+    try:
+        msg_type, payload = proto.recv_frame(conn, request_buffer())
+        if msg_type is None:  # Nếu không có dữ liệu, ngắt kết nối
+            print(f"Connection closed by {addr}")
+            return False
+
+        if msg_type != proto.MSG_COMMAND:
+            proto.send_error(conn, "Expected a command.")
+            return True
+
+        if client.paid:
+            client.paid = False
+        elif client.routed:
+            # Vượt giới hạn của IP nguồn: trả ngay RETRY_AFTER, không xử lý lệnh
+            wait = admission.take(addr[0])
+            if wait:
+                proto.send_retry_after(conn, wait)
+                return True
+
+        handle_command(conn, addr, proto.decode_text(payload).strip(), client.routed)
+        return True
+    except proto.ProtocolError as e:
+        print(f"Protocol error from {addr}: {e}")
+        try:
+            proto.send_error(conn, str(e))
+        except OSError:
+            pass
+    except socket.timeout:
+        print(f"Request from {addr} stalled for {IDLE_TIMEOUT}s, closing.")
     except Exception as e:
         print(f"Error in handle_request: {e}")
+    return False
+
+def handle_command(conn, addr, data, routed=True):
+    """
+    Run one command and send its reply.
+
+    Args:
+        routed (bool): In multi-process mode, send commands about swarms owned by
+            other shards to those shards (see shard.py).
+    """
+    print(f"Received from {addr}: {data.partition(chr(10))[0]}")   # Chỉ in dòng lệnh, không in body
+    command = data.split(None, 1)[0] if data else ""
+    started = time.perf_counter()
+
+    try:
+        if routed and shard.enabled() and shard.handle(conn, data):
+            # Lệnh đã được shard khác trả lời (hoặc gộp kết quả từ nhiều shard)
+            stats.record(command if command in COMMANDS else "UNKNOWN", time.perf_counter() - started)
+            return
+
+        # Phân tích và xử lý yêu cầu
+        if data.startswith("REGISTER_NODE"):
+            _, client_ip, client_port = data.split()
+            swarm.add_node(client_ip, client_port)
+            proto.send_text(conn, "Node registered!")
+
+        elif data.startswith("ANNOUNCE"):
+            '''
+            input ANNOUNCE <node_ip> <node_port>    (heartbeat)
+            output: "OK", or an error if the node must register again
+            '''
+            _, client_ip, client_port = data.split()
+            if swarm.announce(client_ip, client_port):
+                proto.send_text(conn, "OK")
+            else:
+                proto.send_error(conn, "Unknown node.")
+
+        elif data.startswith("REGISTER_FILES"):
+            '''
+            input: REGISTER_FILES <node_ip> <node_port>
+                   <JSON list of [file_name, total_piece, magnet_link]>
+            output: JSON {"registered": <count>, "message": <text>}
+            '''
+            line, _, body = data.partition("\n")
+            _, client_ip, client_port = line.split()
+            response = swarm.add_files(client_ip, client_port, json.loads(body))
+            proto.send_json(conn, response)
+
+        elif data.startswith("REGISTER_FILE"):
+            '''
+            input REGISTTER_FILE <node_ip> <node_port> <file_name> <total_piece> <magnet_link>
+            output: message from the DB
+            '''
+
+            _, client_ip, client_port, file_name, total_piece, magnet_link = data.split()                
+            response = swarm.add_file(file_name, int(total_piece), magnet_link, client_ip, client_port)
+            proto.send_text(conn, response)
+
+        elif data.startswith("HAVE_PIECES"):
+            '''
+            input HAVE_PIECES <node_ip> <node_port> <info_hash> <base64 bitfield>
+                  (an all-zero bitfield withdraws the pieces reported so far)
+            output: "OK" or an error message
+            '''
+            _, client_ip, client_port, info_hash, bitfield = data.split()
+            response = swarm.have_pieces(client_ip, client_port, info_hash, proto.decode_bitfield(bitfield))
+            if response == "OK":
+                proto.send_text(conn, response)
+            else:
+                proto.send_error(conn, response)
+
+        elif data.startswith("FIND_FILES"):
+            '''
+            input FIND_FILES <key_1> <key_2> ... <key_n> [numwant=<n>] [compact=1]
+                   (key = file name, info_hash or magnet link)
+            output: JSON {"files": {key: {"nodes", "file_name", "info_hash", "magnet_link", "total_piece", "bitfields"} or null}}
+                    or the same in MSG_COMPACT form if compact=1
+            '''
+            keys, options = proto.split_options(data.split()[1:])
+            response = swarm.lookup_many(keys, int(options.get("numwant", 0)))
+            proto.send_find_files_reply(conn, response, options.get("compact") == "1")
+
+        elif data.startswith("FIND_FILE"):
+            '''
+            input FIND_FILE  <file_name | info_hash | magnet_link> [numwant=<n>] [compact=1]
+            output: JSON {"nodes", "file_name", "info_hash", "magnet_link", "total_piece", "bitfields"},
+                    or with compact=1 a MSG_COMPACT frame (6 bytes per IPv4 peer, 18 per IPv6 peer)
+            '''
+            (key,), options = proto.split_options(data.split()[1:])
+            # Reply đã encode sẵn trong cache của swarm: chỉ còn một lần sendall
+            frame = swarm.find_reply(key, int(options.get("numwant", 0)), options.get("compact") == "1")
+
+            if frame is None:
+                proto.send_error(conn, f"File {key} not found.")
+            else:
+                conn.sendall(frame)
+
+        elif data.startswith("REPORT_TRANSFERS"):
+            '''
+            input: REPORT_TRANSFERS <node_ip> <node_port>
+                   <JSON list of [upload_ip, upload_port, info_hash, piece_index, bytes]>
+                   (pieces the node downloaded since its last report)
+            output: "OK", the rows are written to Transactions in the background
+            '''
+            line, _, body = data.partition("\n")
+            _, client_ip, client_port = line.split()
+            swarm.record_transfers(client_ip, client_port, json.loads(body))
+            proto.send_text(conn, "OK")
+
+        elif data.startswith("ANALYTICS"):
+            '''
+            input ANALYTICS [limit=<n>]
+            output: JSON from db_manager.swarm_analytics (top uploaders, bytes per swarm, completed downloads)
+            '''
+            _, options = proto.split_options(data.split()[1:])
+            proto.send_json(conn, db.swarm_analytics(int(options.get("limit", 10))))
+
+        elif data.startswith("DISCONNECT"):     # DISCONNECT hoặc DISCONNECT_NODE
+            _, client_ip, client_port = data.split()
+            swarm.remove_node(client_ip, client_port)
+            proto.send_text(conn, "Node disconnected.")
+
+        else:
+            proto.send_error(conn, "Unknown command.")
+    except (ValueError, IndexError, TypeError, AttributeError, KeyError) as e:
+        # Thiếu/thừa tham số, số không hợp lệ, JSON/bitfield hỏng hoặc sai cấu trúc: báo lỗi, giữ connection
+        print(f"Malformed command from {addr}: {e}")
+        proto.send_error(conn, "Malformed command.")
+
+    stats.record(command if command in COMMANDS else "UNKNOWN", time.perf_counter() - started)
+
+def udp_announce(ip, port):
+    """
+    ANNOUNCE received on the UDP endpoint (see udp_tracker.py).
+    """
+    started = time.perf_counter()
+    if shard.enabled():
+        shard.broadcast(f"ANNOUNCE {ip} {port}")
+    known = swarm.announce(ip, port)
+    stats.record("UDP_ANNOUNCE", time.perf_counter() - started)
+    return known
+
+def udp_lookup(info_hash, numwant):
+    """
+    LOOKUP received on the UDP endpoint: FIND_FILE by info_hash.
+    """
+    started = time.perf_counter()
+    owner = shard.key_shard(info_hash) if shard.enabled() else None
+    if owner is None or owner == shard.SHARD_INDEX:
+        response = swarm.lookup(info_hash, numwant)
+    else:
+        msg_type, payload = shard.forward(owner, f"FIND_FILE {info_hash} numwant={numwant}")
+        response = json.loads(payload.decode('utf-8')) if msg_type == proto.MSG_JSON else None
+    stats.record("UDP_LOOKUP", time.perf_counter() - started)
+    return response
+
+def serve_connection(client):
+    """
+    Worker entry point: answer the request that made the connection readable,
+    then give the connection back to the selector (or close it).
+    """
+    global active_connections, queued_connections
+    with active_lock:
+        queued_connections -= 1
+        active_connections += 1
+    try:
+        keep_open = serve_request(client)
+        # Request tiếp theo tới ngay sau reply (node gửi nhiều lệnh liên tiếp): trả lời luôn,
+        # không quay lại selector. Có giới hạn để một node không giữ worker mãi.
+        for _ in range(FOLLOW_UP_REQUESTS):
+            if not keep_open or not readable(client.conn, FOLLOW_UP_WAIT):
+                break
+            keep_open = serve_request(client)
     finally:
-        conn.close()
+        with active_lock:
+            active_connections -= 1
+
+    if keep_open and not stop_event.is_set():
+        returned_clients.append(client)
+        try:
+            wakeup_socket.send(b"\0")     # Đánh thức selector để nó theo dõi lại connection
+        except OSError:
+            pass    # Buffer đầy thì selector cũng đang có byte để thức dậy
+    else:
+        close_client(client)
+
+def readable(conn, timeout):
+    if hasattr(select, "poll"):
+        # poll thay vì select: select không nhận fd >= 1024
+        poller = select.poll()
+        poller.register(conn, select.POLLIN)
+        return bool(poller.poll(timeout * 1000))
+    return bool(select.select([conn], [], [], timeout)[0])
+
+def close_client(client):
+    global open_connections
+    client.conn.close()
+    with active_lock:
+        open_connections -= 1
+
+def reject(conn, addr, seconds, reason):
+    """
+    Turn a new connection away with a RETRY_AFTER frame, from the accept loop.
+    """
+    global rejected_connections
+    with active_lock:
+        rejected_connections += 1
+    print(f"{reason}, asking {addr} to retry after {seconds:.1f}s")
+    try:
+        proto.send_retry_after(conn, seconds)
+    except OSError:
+        pass
+    conn.close()
+
+def accept_client(selector, server_socket):
+    """
+    Accept one connection and put it in the selector, or turn it away.
+
+    Admission control happens here, before a worker is involved: a connection is
+    refused with RETRY_AFTER when its source IP is over the rate limit, when
+    MAX_CONNECTIONS are already open, or when MAX_QUEUED requests are already
+    waiting for a worker. The node then backs off instead of piling up in the backlog.
+    """
+    global open_connections
+    try:
+        conn, addr = server_socket.accept()
+    except OSError:
+        return  # Connection đã bị huỷ, hoặc server_socket đã bị đóng
+
+    wait = admission.take(addr[0])
+    if wait:
+        reject(conn, addr, wait, "Rate limit exceeded")
+        return
+    if queued_connections >= MAX_QUEUED:
+        reject(conn, addr, RETRY_AFTER, "Work queue full")
+        return
+    if open_connections >= MAX_CONNECTIONS:
+        reject(conn, addr, RETRY_AFTER, "Too many connections")
+        return
+
+    conn.settimeout(IDLE_TIMEOUT)   # Giới hạn thời gian một request gửi dở chiếm worker
+    with active_lock:
+        open_connections += 1
+    selector.register(conn, selectors.EVENT_READ, Client(conn, addr))
+
+def close_idle_clients(selector):
+    now = time.monotonic()
+    for key in list(selector.get_map().values()):
+        client = key.data
+        if client and now - client.last_active > IDLE_TIMEOUT:
+            print(f"Connection from {client.addr} idle for {IDLE_TIMEOUT}s, closing.")
+            selector.unregister(client.conn)
+            close_client(client)
+
+def serve_connections(server_socket):
+    """
+    Accept loop and selector of the node connections. A connection only holds a
+    worker while one of its requests is being answered: between requests it
+    waits here, so slow or idle nodes no longer starve the worker pool. A
+    connection that sends nothing for IDLE_TIMEOUT is closed.
+    """
+    global wakeup_socket, queued_connections
+    selector = selectors.DefaultSelector()
+    wakeup_reader, wakeup_socket = socket.socketpair()
+    wakeup_reader.setblocking(False)
+    wakeup_socket.setblocking(False)
+    server_socket.setblocking(False)
+    selector.register(server_socket, selectors.EVENT_READ)
+    selector.register(wakeup_reader, selectors.EVENT_READ)
+    last_sweep = time.monotonic()
+
+    # select() có timeout để main thread định kỳ quay lại vòng lặp: SIGTERM có thể
+    # được kernel giao cho thread khác, khi đó signal handler chỉ chạy khi main
+    # thread thực thi lại code Python.
+    while not stop_event.is_set():
+        for key, _ in selector.select(timeout=1.0):
+            if key.fileobj is server_socket:
+                accept_client(selector, server_socket)
+
+            elif key.fileobj is wakeup_reader:
+                try:
+                    wakeup_reader.recv(4096)
+                except OSError:
+                    pass
+                while returned_clients:
+                    client = returned_clients.popleft()
+                    client.last_active = time.monotonic()
+                    selector.register(client.conn, selectors.EVENT_READ, client)
+
+            else:
+                # Có request: chuyển connection cho worker cho tới khi trả lời xong
+                client = key.data
+                selector.unregister(client.conn)
+                with active_lock:
+                    queued_connections += 1
+                try:
+                    executor.submit(serve_connection, client)
+                except RuntimeError:
+                    # Executor đã shutdown
+                    with active_lock:
+                        queued_connections -= 1
+                    close_client(client)
+
+        if time.monotonic() - last_sweep >= 1.0:
+            close_idle_clients(selector)
+            last_sweep = time.monotonic()
+
+    for key in list(selector.get_map().values()):
+        if key.data:
+            close_client(key.data)
+    selector.close()
+    wakeup_reader.close()
+    wakeup_socket.close()
 
 def handle_cli_input():
     global server_socket
@@ -99,6 +465,12 @@ def handle_cli_input():
                 # sys.exit(0) 
                 signal_handler(0, 0)
 
+            elif user_input.startswith("STATS"):
+                print(stats.format_report(stats.snapshot()))
+
+            elif user_input.startswith("ANALYTICS"):
+                print(json.dumps(db.swarm_analytics(), indent=2))
+
             elif user_input.startswith("DISPLAY"):
                 _, table_name = user_input.split()
                 if table_name == "Nodes":
@@ -126,9 +498,25 @@ def handle_cli_input():
 
 #Handle Ctrl+C
 def signal_handler(sig, frame):
+    """
+    Only wake up the accept loop here; the actual cleanup runs in shutdown() on the
+    main thread once serve_connections() returns. Doing it inside the handler
+    could deadlock on a lock the interrupted main thread already holds.
+    """
     global server_socket
     print('Terminating the server...')
+    stop_event.set()
+    try:
+        server_socket.shutdown(socket.SHUT_RDWR)    # Đánh thức select() kể cả khi gọi từ CLI thread
+    except OSError:
+        pass
     server_socket.close()
+
+def shutdown():
+    if executor:
+        executor.shutdown(wait=False, cancel_futures=True)
+    swarm.flush()
+    db.close_db()   # Connection của main thread (flush, load_from_db)
     sys.exit(0)
 
 def stop_cli_thread():
@@ -139,30 +527,127 @@ def stop_cli_thread():
     signal.signal(signal.SIGTERM, signal_handler)
 
 
-if __name__ == "__main__":
+def run_tracker(args, shard_index=0):
+    """
+    Start one tracker process and serve until it is told to stop.
+
+    Args:
+        args (argparse.Namespace): Command line options.
+        shard_index (int): Index of this process when running with --processes N.
+    """
+    global server_socket, executor, MAX_WORKERS, MAX_CONNECTIONS, IDLE_TIMEOUT, MAX_QUEUED, RETRY_AFTER
+
     #hostname = socket.gethostname()
-    hostip = get_host_default_interface_ip()
-    port = 22236
+    hostip = args.host or get_host_default_interface_ip()
+    port = args.port
+    MAX_WORKERS = args.max_workers
+    MAX_CONNECTIONS = args.max_connections
+    IDLE_TIMEOUT = args.idle_timeout
+    MAX_QUEUED = args.max_queued
+    RETRY_AFTER = args.retry_after
+    admission.configure(args.rate_limit, args.rate_burst)
     print("Listening on: {}:{}".format(hostip,port))
 
-    initialize_database()
-    delete_all_data()
+    shard.configure(shard_index, args.processes, args.shard_base_port or port + 1)
+    if shard.enabled():
+        db.DB_NAME = f"tracker_shard{shard_index}.db"     # Mỗi shard một file DB
+
+    initialize_database(db.DB_NAME)
+    swarm.PEER_TTL = args.peer_ttl
+    if args.persistent:
+        # Khởi động lại "ấm": node cũ không phải đăng ký lại, chỉ cần ANNOUNCE
+        swarm.load_from_db()
+    else:
+        delete_all_data(db.DB_NAME)
+    swarm.start_writer()
+    swarm.start_sweeper()
+
+    stats.register_gauge("open_connections", lambda: open_connections)
+    stats.register_gauge("active_connections", lambda: active_connections)
+    stats.register_gauge("queued_connections", lambda: queued_connections)
+    stats.register_gauge("rejected_connections", lambda: rejected_connections)
+    stats.register_gauge("admission", admission.sizes)
+    stats.register_gauge("swarm", swarm.sizes)
+    stats.register_gauge("dropped_writes", lambda: db.dropped_ops)
+    if args.stats_port:
+        stats.start_dump_server(args.stats_port + shard_index)
 
 
-    #For CLI debug
-    cli_thread = Thread(target=handle_cli_input, daemon=True)
-    cli_thread.start()
+    #For CLI debug (các shard dùng chung stdin nên chỉ bật khi chạy một process)
+    if not shard.enabled():
+        cli_thread = Thread(target=handle_cli_input, daemon=True)
+        cli_thread.start()
+
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="tracker-worker")
 
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if shard.enabled():
+        # Các shard cùng bind một port, kernel chia connection cho từng process
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        shard.start_internal_server(lambda conn, addr: start_tracker_process(conn, addr, routed=False))
     server_socket.bind((hostip, port))
-    server_socket.listen(20)     # Listen at most 10 connections
+    server_socket.listen(min(MAX_CONNECTIONS, socket.SOMAXCONN))
+
+    if args.udp_port != 0:
+        udp_tracker.start_server(hostip, args.udp_port or port, udp_announce, udp_lookup, reuse_port=shard.enabled())
 
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    while True:
-        print("Waiting for connection...")
-        conn, addr = server_socket.accept()      #Lệnh này mang tính blocking, chờ kết nối từ client
-        node_thread = Thread(target=start_tracker_process, args=(conn, addr))
-        node_thread.start()
-        node_thread.join()
+    print(f"Serving with {MAX_WORKERS} workers, at most {MAX_CONNECTIONS} connections ({MAX_QUEUED} requests waiting), idle timeout {IDLE_TIMEOUT}s")
+    if admission.enabled():
+        print(f"Rate limit: {admission.RATE:g} commands/s per IP, burst {admission.BURST:g}")
+    serve_connections(server_socket)
+    shutdown()
+
+def run_sharded(args):
+    """
+    Run args.processes tracker processes on the same port, each owning the
+    swarms of one shard of the info_hash space (see shard.py). The parent only
+    waits for them and passes SIGINT/SIGTERM on.
+    """
+    processes = [multiprocessing.Process(target=run_tracker, args=(args, index), name=f"tracker-shard-{index}")
+                 for index in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    def stop_shards(sig, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()     # SIGTERM -> shard tự shutdown() và ghi nốt DB
+
+    signal.signal(signal.SIGINT, stop_shards)
+    signal.signal(signal.SIGTERM, stop_shards)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Tracker",
+        description="Run the P2P tracker.",
+    )
+    parser.add_argument("--host", default=None, help="IP to listen on (default: auto-detect).")
+    parser.add_argument("--port", type=int, default=22236, help="Port to listen on.")
+    parser.add_argument("--max-workers", type=int, default=MAX_WORKERS, help="Size of the worker thread pool.")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS, help="Maximum number of open node connections.")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT, help="Seconds before an idle connection is closed.")
+    parser.add_argument("--max-queued", type=int, default=MAX_QUEUED, help="Requests allowed to wait for a worker before new connections get RETRY_AFTER.")
+    parser.add_argument("--retry-after", type=float, default=RETRY_AFTER, help="Seconds suggested to nodes turned away because the tracker is full.")
+    parser.add_argument("--rate-limit", type=float, default=admission.RATE, help="Connections + commands per second allowed per source IP (0 to disable).")
+    parser.add_argument("--rate-burst", type=float, default=admission.BURST, help="Burst size of the per-IP rate limit.")
+    parser.add_argument("--peer-ttl", type=float, default=swarm.PEER_TTL, help="Seconds without ANNOUNCE before a node is dropped.")
+    parser.add_argument("--persistent", action="store_true", help="Keep tracker.db across restarts and reload the swarm from it.")
+    parser.add_argument("--stats-port", type=int, default=None, help="Serve a JSON stats dump on 127.0.0.1:<port> (+ shard index).")
+    parser.add_argument("--udp-port", type=int, default=None, help="UDP port for ANNOUNCE/LOOKUP (default: same as --port, 0 to disable).")
+    parser.add_argument("--processes", type=int, default=1, help="Number of tracker processes, sharded by info_hash.")
+    parser.add_argument("--shard-base-port", type=int, default=None, help="Shard i takes forwarded commands on 127.0.0.1:<port>+i (default: --port + 1).")
+    args = parser.parse_args()
+
+    if args.processes > 1:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            parser.error("--processes needs SO_REUSEPORT, which this platform does not support.")
+        run_sharded(args)
+    else:
+        run_tracker(args)
@@ -0,0 +1,74 @@
+import time
+from threading import Lock
+
+'''
+Admission control của tracker: giới hạn tốc độ theo IP nguồn.
+
+Mỗi IP có một token bucket: RATE token/giây, tối đa BURST token. Mỗi connection
+mới tốn một token (gồm cả lệnh đầu tiên trên connection), mỗi lệnh sau đó tốn
+thêm một token; hết token thì tracker không xử lý mà trả ngay
+frame MSG_RETRY_AFTER kèm số giây cần chờ (xem Tracker.py), node thử lại sau
+khoảng đó cộng jitter (xem Node.with_tracker).
+
+Giới hạn tính theo địa chỉ nguồn của connection, không theo ip/port node tự
+khai trong lệnh, nên một máy không thể lách bằng cách đổi tên node.
+'''
+
+RATE = 100.0                # Token mỗi giây cho mỗi IP, 0 = tắt giới hạn
+BURST = 200.0               # Số token tối đa (số lệnh dồn dập được phép)
+MIN_RETRY_AFTER = 0.1       # Giây, tránh gợi ý chờ quá ngắn
+MAX_TRACKED_IPS = 100000    # Quá số này thì bỏ bucket của các IP đã đầy token (đang rảnh)
+
+buckets = {}        # ip -> [tokens, thời điểm cập nhật]
+throttled = 0       # Số lần đã từ chối vì vượt giới hạn
+admission_lock = Lock()
+
+
+def configure(rate, burst):
+    global RATE, BURST
+    RATE = rate
+    BURST = max(burst, 1.0)
+
+def enabled():
+    return RATE > 0
+
+def _prune(now):
+    # Gọi khi đang giữ admission_lock. IP có bucket đã hồi đầy không cần nhớ nữa
+    for ip in [ip for ip, (tokens, last) in buckets.items() if tokens + (now - last) * RATE >= BURST]:
+        del buckets[ip]
+
+def take(ip, now=None):
+    """
+    Spend one token of `ip`.
+
+    Returns:
+        float: 0 if the request may go on, otherwise the seconds until the next token.
+    """
+    global throttled
+    if not enabled():
+        return 0.0
+    now = time.monotonic() if now is None else now
+
+    with admission_lock:
+        bucket = buckets.get(ip)
+        if bucket is None:
+            if len(buckets) >= MAX_TRACKED_IPS:
+                _prune(now)
+            bucket = buckets[ip] = [BURST, now]
+
+        tokens = min(BURST, bucket[0] + (now - bucket[1]) * RATE)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+
+        bucket[0] = tokens
+        throttled += 1
+        return max(MIN_RETRY_AFTER, (1 - tokens) / RATE)
+
+def sizes():
+    """
+    Gauge for the stats module.
+    """
+    with admission_lock:
+        return {"tracked_ips": len(buckets), "throttled": throttled}
@@ -0,0 +1,223 @@
+import asyncio
+import concurrent.futures
+import socket
+from collections import deque
+from threading import Thread
+
+import file_transfer as f_sys
+import protocol as proto
+
+'''
+Engine truyền file của node trên asyncio (Node.py --engine asyncio).
+
+Một event loop chạy trong thread riêng, vừa phục vụ REQUEST_PIECE cho mọi peer
+(asyncio.start_server, mỗi connection là một coroutine thay vì một thread), vừa
+chạy phần tải piece của mọi file đang tải: DownloadScheduler của file_transfer
+với worker là task và PeerSession dùng stream.
+
+Phần còn lại vẫn là code blocking chạy ở thread của người gọi: CLI, tracker,
+ghép và kiểm tra file trong file_transfer.download_file. Các lệnh REQUEST_FILE,
+REQUEST_MUL chỉ cần truyền engine vào download_file.
+'''
+
+PEER_TIMEOUT = 20       # Giây chờ reply của peer, giống timeout của socket trong file_transfer
+
+
+class AsyncPeerSession:
+    """
+    PeerSession over asyncio streams: one connection per peer, up to `window`
+    REQUEST_PIECE in flight, replies read in request order.
+    """
+
+    def __init__(self, peer_ip, peer_port, reader, writer, window=None):
+        self.peer_ip = peer_ip
+        self.peer_port = peer_port
+        self.reader = reader
+        self.writer = writer
+        self.window = max(1, window or f_sys.PIPELINE_WINDOW)
+
+    @classmethod
+    async def open(cls, peer_ip, peer_port, window=None):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(peer_ip, peer_port), f_sys.CONNECT_TIMEOUT)
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cls(peer_ip, peer_port, reader, writer, window)
+
+    async def fetch(self, file_name, piece_indices, piece_size, on_piece):
+        """
+        Download the given pieces over this connection.
+
+        Args:
+            on_piece (coroutine function): await on_piece(piece_index, data) for each piece received.
+
+        Returns:
+            list: Indices the peer answered with an error.
+        """
+        waiting = deque(piece_indices)
+        in_flight = deque()
+        failed = []
+
+        while waiting or in_flight:
+            frames = []
+            while waiting and len(in_flight) < self.window:
+                piece_index = waiting.popleft()
+                frames.append(proto.encode_frame(proto.MSG_COMMAND, f"REQUEST_PIECE {file_name} {piece_index} {piece_size}"))
+                in_flight.append(piece_index)
+            if frames:
+                self.writer.write(b"".join(frames))
+                await self.writer.drain()
+
+            piece_index = in_flight.popleft()
+            msg_type, data = await asyncio.wait_for(proto.read_frame(self.reader), PEER_TIMEOUT)
+            if msg_type is None:
+                raise ConnectionError(f"{self.peer_ip}:{self.peer_port} closed the connection")
+            if msg_type == proto.MSG_PIECE and data:
+                await on_piece(piece_index, data)
+            else:
+                print(f"Failed to download piece {piece_index} from {self.peer_ip}:{self.peer_port}: {proto.decode_text(data)}")
+                failed.append(piece_index)
+        return failed
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncDownloadScheduler(f_sys.DownloadScheduler):
+    """
+    DownloadScheduler whose workers are tasks on the engine's event loop.
+    Same queue, per-peer limits and retry rules; run() blocks the calling thread.
+    """
+
+    def __init__(self, engine, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.engine = engine
+        self.changed = None     # asyncio.Condition, tạo trên event loop trong _run()
+
+    async def _worker(self):
+        while True:
+            peer, batch = self._claim()
+            while peer is None:
+                if not self.busy:
+                    return
+                async with self.changed:
+                    await self.changed.wait()
+                peer, batch = self._claim()
+
+            done = set()
+            reachable = True
+            async def save(piece_index, piece_data):
+                # Ghi file là blocking, không chạy trên event loop
+                await asyncio.to_thread(self.on_piece, piece_index, peer[0], peer[1], piece_data)
+                done.add(piece_index)
+
+            session = None
+            try:
+                session = await AsyncPeerSession.open(peer[0], peer[1], self.window)
+                await session.fetch(self.file_name, batch, self.piece_size, save)
+            except Exception as e:
+                print(f"Error downloading from {peer[0]}:{peer[1]}: {e!r}")
+                reachable = session is not None
+            finally:
+                if session:
+                    session.close()
+                self._release(peer, batch, done, reachable)
+                async with self.changed:
+                    self.changed.notify_all()
+
+    async def _run(self):
+        self.changed = asyncio.Condition()
+        await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+
+    def run(self, on_tick=None):
+        future = self.engine.submit(self._run())
+        while True:
+            try:
+                return future.result(timeout=f_sys.PROGRESS_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                if on_tick:
+                    on_tick()
+
+
+class TransferEngine:
+    """
+    The node's event loop, in a daemon thread. Serves REQUEST_PIECE on host:port
+    and runs downloads for blocking callers, e.g.
+        f_sys.download_file(..., engine=engine)
+    """
+
+    def __init__(self, root_folder):
+        self.root_folder = root_folder
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True, name="transfer-engine")
+        self.server = None
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine on the engine loop from any thread.
+
+        Returns:
+            concurrent.futures.Future: Its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def start(self, host, port):
+        self.thread.start()
+        self.server = self.submit(asyncio.start_server(self._serve_peer, host, port, backlog=socket.SOMAXCONN)).result()
+        print(f"Node listening on {host}:{port} (asyncio engine)")
+
+    def scheduler(self, *args, **kwargs):
+        """
+        AsyncDownloadScheduler bound to this engine; file_transfer.download_file
+        uses it in place of DownloadScheduler.
+        """
+        return AsyncDownloadScheduler(self, *args, **kwargs)
+
+    async def _serve_peer(self, reader, writer):
+        """
+        Request loop of one peer connection; pipelined requests are answered in order.
+        """
+        addr = writer.get_extra_info("peername")
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                msg_type, payload = await proto.read_frame(reader)
+                if msg_type is None:
+                    break
+                if msg_type != proto.MSG_COMMAND:
+                    writer.write(proto.encode_frame(proto.MSG_ERROR, "Expected a command."))
+                    continue
+
+                data = proto.decode_text(payload).strip()
+                if data.startswith("REQUEST_PIECE"):
+                    '''
+                    REQUEST_PIECE <file_name> <piece_index> [<piece_size>]
+                    '''
+                    try:
+                        _, file_name, piece_index, *piece_size = data.split()
+                        piece_index = int(piece_index)
+                        piece_size = int(piece_size[0]) if piece_size else None
+                    except ValueError:
+                        piece_data, error = None, "Malformed command."
+                    else:
+                        try:
+                            piece_data, error = await asyncio.to_thread(
+                                f_sys.read_piece, self.root_folder, file_name, piece_index, piece_size)
+                        except OSError as e:
+                            # Lỗi đọc của một request không được đóng connection (bỏ các request đang pipeline)
+                            print(f"Error reading piece {piece_index} of file {file_name}: {e}")
+                            piece_data, error = None, f"Could not read piece {piece_index} of file {file_name}."
+                    if error:
+                        writer.write(proto.encode_frame(proto.MSG_ERROR, error))
+                    else:
+                        writer.write(proto.encode_frame(proto.MSG_PIECE, piece_data))
+                else:
+                    writer.write(proto.encode_frame(proto.MSG_ERROR, "Unknown command."))
+                await writer.drain()
+        except (OSError, proto.ProtocolError) as e:
+            print(f"Error handling peer {addr}: {e}")
+        finally:
+            writer.close()
+
+    def stop(self):
+        if self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
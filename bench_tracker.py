@@ -0,0 +1,279 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread, Event
+
+import protocol as proto
+
+'''
+Load generator cho tracker.
+
+Giả lập hàng nghìn node ảo (IP 10.x.y.z) gửi REGISTER_NODE, REGISTER_FILE,
+ANNOUNCE, FIND_FILE, FIND_FILES... tới một tracker chạy ở localhost, theo tỉ lệ
+cấu hình bằng --mix, rồi in throughput và latency p50/p90/p99 của từng lệnh.
+
+Ví dụ:
+    python Tracker.py --host 127.0.0.1 --port 22236 > /dev/null
+    python bench_tracker.py --nodes 2000 --duration 20 --mix find_file=8,announce=2
+
+Hoặc để script tự chạy tracker (stdout của tracker bị bỏ đi):
+    python bench_tracker.py --start-tracker --port 23000 --json result.json
+
+Mọi node ảo gửi từ cùng 127.0.0.1 nên sẽ chạm giới hạn theo IP của tracker;
+--start-tracker chạy tracker với --rate-limit 0. Khi tracker trả RETRY_AFTER,
+request được tính vào cột "throttled" và worker chờ đúng khoảng đó rồi kết nối lại.
+'''
+
+DEFAULT_MIX = "register_node=1,register_file=2,announce=3,find_file=10,find_files=1"
+FIND_FILES_BATCH = 10       # Số file trong mỗi FIND_FILES
+REGISTER_BATCH_SIZE = 1000  # Số file trong mỗi REGISTER_FILES khi nạp dữ liệu ban đầu
+
+
+'''
+Virtual nodes
+'''
+def node_address(index):
+    return f"10.{(index >> 16) & 255}.{(index >> 8) & 255}.{index & 255}", 1100
+
+def file_entry(node_index, file_index):
+    file_name = f"bench_{node_index}_{file_index}.bin"
+    info_hash = hashlib.sha1(file_name.encode()).hexdigest()
+    return [file_name, 16, f"magnet:?xt=urn:btih:{info_hash}&dn={file_name}"]
+
+def connect(host, port):
+    sock = socket.create_connection((host, port), timeout=10)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def request_patiently(sock, command):
+    """
+    proto.request, waiting and sending again while the tracker answers RETRY_AFTER.
+    """
+    while True:
+        try:
+            return proto.request(sock, command)
+        except proto.RetryAfter as e:
+            time.sleep(e.seconds)
+
+def populate(host, port, nodes, files_per_node):
+    """
+    Register every virtual node and its files before the measured run, so
+    FIND_FILE and ANNOUNCE hit a realistic index.
+    """
+    sock = connect(host, port)
+    try:
+        for node_index in range(nodes):
+            ip, node_port = node_address(node_index)
+            request_patiently(sock, f"REGISTER_NODE {ip} {node_port}")
+            batch = [file_entry(node_index, file_index) for file_index in range(files_per_node)]
+            for start in range(0, len(batch), REGISTER_BATCH_SIZE):
+                body = json.dumps(batch[start:start + REGISTER_BATCH_SIZE])
+                request_patiently(sock, f"REGISTER_FILES {ip} {node_port}\n{body}")
+    finally:
+        sock.close()
+
+
+'''
+Request mix
+'''
+def parse_mix(text):
+    """
+    "find_file=10,announce=3" -> ([op names], [weights])
+    """
+    ops, weights = [], []
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name}, expected one of {', '.join(OPERATIONS)}")
+        ops.append(name)
+        weights.append(float(weight or 1))
+    return ops, weights
+
+def op_register_node(state):
+    state["next_node"] += 1
+    ip, node_port = node_address(state["next_node"])
+    return f"REGISTER_NODE {ip} {node_port}"
+
+def op_register_file(state):
+    node_index = random.randrange(state["nodes"])
+    ip, node_port = node_address(node_index)
+    file_name, total_piece, magnet_link = file_entry(node_index, random.randrange(state["files_per_node"] * 2))
+    return f"REGISTER_FILE {ip} {node_port} {file_name} {total_piece} {magnet_link}"
+
+def op_announce(state):
+    ip, node_port = node_address(random.randrange(state["nodes"]))
+    return f"ANNOUNCE {ip} {node_port}"
+
+def op_find_file(state):
+    file_name = file_entry(random.randrange(state["nodes"]), random.randrange(state["files_per_node"]))[0]
+    return f"FIND_FILE {file_name} {state['find_options']}"
+
+def op_find_files(state):
+    names = [file_entry(random.randrange(state["nodes"]), random.randrange(state["files_per_node"]))[0]
+             for _ in range(FIND_FILES_BATCH)]
+    return "FIND_FILES " + " ".join(names) + " " + state["find_options"]
+
+OPERATIONS = {
+    "register_node": op_register_node,
+    "register_file": op_register_file,
+    "announce": op_announce,
+    "find_file": op_find_file,
+    "find_files": op_find_files,
+}
+
+
+'''
+Workers
+'''
+def worker(host, port, ops, weights, state, stop, results):
+    """
+    Send requests on one persistent connection until `stop` is set, recording
+    the latency of each request in results[op]["latencies"]. A RETRY_AFTER reply
+    is counted in results[op]["throttled"]; the worker then waits as asked and
+    reconnects (the tracker closes connections it turns away at accept).
+    """
+    sock = connect(host, port)
+    buffer = bytearray(64 * 1024)
+    try:
+        while not stop.is_set():
+            op = random.choices(ops, weights)[0]
+            request = OPERATIONS[op](state)
+            started = time.perf_counter()
+            try:
+                msg_type, _ = proto.request(sock, request, buffer)
+            except proto.RetryAfter as e:
+                results[op]["throttled"] += 1
+                sock.close()
+                stop.wait(e.seconds)
+                sock = connect(host, port)
+                continue
+            elapsed = time.perf_counter() - started
+
+            result = results[op]
+            result["latencies"].append(elapsed)
+            if msg_type == proto.MSG_ERROR:
+                result["errors"] += 1
+    except Exception as e:
+        print(f"Worker error: {e}")
+    finally:
+        sock.close()
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def summarize(results, elapsed):
+    report = {"elapsed": round(elapsed, 3), "total_requests": 0, "throughput": 0.0, "operations": {}}
+    for op, result in results.items():
+        latencies = sorted(result["latencies"])
+        if not latencies:
+            continue
+        report["operations"][op] = {
+            "count": len(latencies),
+            "errors": result["errors"],
+            "throttled": result["throttled"],
+            "throughput": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p90_ms": round(percentile(latencies, 0.90) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+            "max_ms": round(latencies[-1] * 1000, 3),
+        }
+        report["total_requests"] += len(latencies)
+    report["throughput"] = round(report["total_requests"] / elapsed, 1)
+    return report
+
+def print_report(report):
+    print(f"\n{report['total_requests']} requests in {report['elapsed']}s -> {report['throughput']} req/s")
+    print(f"{'operation':<16}{'count':>9}{'errors':>8}{'throttled':>11}{'req/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for op, row in report["operations"].items():
+        print(f"{op:<16}{row['count']:>9}{row['errors']:>8}{row['throttled']:>11}{row['throughput']:>10}"
+              f"{row['p50_ms']:>10}{row['p90_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+
+
+def start_tracker(port):
+    """
+    Run Tracker.py from this folder in a temporary directory so the benchmark
+    never touches the real tracker.db. The per-IP rate limit is turned off: every
+    virtual node shares 127.0.0.1.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix="bench_tracker_")
+    tracker = subprocess.Popen(
+        [sys.executable, os.path.join(here, "Tracker.py"), "--host", "127.0.0.1", "--port", str(port),
+         "--rate-limit", "0"],
+        cwd=workdir, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        env=dict(os.environ, PYTHONPATH=here),
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return tracker
+        except OSError:
+            time.sleep(0.1)
+    tracker.kill()
+    raise RuntimeError("Tracker did not start")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="bench_tracker",
+        description="Measure tracker throughput and latency with simulated nodes.",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Tracker IP.")
+    parser.add_argument("--port", type=int, default=22236, help="Tracker port.")
+    parser.add_argument("--nodes", type=int, default=1000, help="Number of virtual nodes registered before the run.")
+    parser.add_argument("--files-per-node", type=int, default=5, help="Files registered by each virtual node.")
+    parser.add_argument("--connections", type=int, default=32, help="Concurrent client connections.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of measured load.")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Request mix as op=weight,... (ops: %s)." % ", ".join(OPERATIONS))
+    parser.add_argument("--numwant", type=int, default=50, help="numwant sent with FIND_FILE(S).")
+    parser.add_argument("--no-compact", action="store_true", help="Ask for JSON peer lists instead of compact ones.")
+    parser.add_argument("--start-tracker", action="store_true", help="Start Tracker.py on --port for the run.")
+    parser.add_argument("--json", default=None, help="Also write the report to this JSON file.")
+    args = parser.parse_args()
+
+    ops, weights = parse_mix(args.mix)
+    tracker = start_tracker(args.port) if args.start_tracker else None
+
+    try:
+        started = time.perf_counter()
+        populate(args.host, args.port, args.nodes, args.files_per_node)
+        print(f"Registered {args.nodes} nodes x {args.files_per_node} files in {time.perf_counter() - started:.2f}s")
+
+        state = {
+            "nodes": args.nodes,
+            "files_per_node": args.files_per_node,
+            "next_node": args.nodes,
+            "find_options": f"numwant={args.numwant}" + ("" if args.no_compact else " compact=1"),
+        }
+        results = {op: {"latencies": [], "errors": 0, "throttled": 0} for op in ops}
+        stop = Event()
+        threads = [Thread(target=worker, args=(args.host, args.port, ops, weights, state, stop, results))
+                   for _ in range(args.connections)]
+
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        stop.wait(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        report = summarize(results, time.perf_counter() - started)
+        report["config"] = vars(args)
+        print_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+    finally:
+        if tracker:
+            tracker.terminate()
+            tracker.wait(timeout=10)
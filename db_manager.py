@@ -1,201 +1,290 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
+
+import stats
+
+DB_NAME = 'tracker.db'
+STATEMENT_CACHE_SIZE = 256      # Số prepared statement sqlite3 giữ lại trên mỗi connection
+
+_local = threading.local()
+dropped_ops = 0                 # Số thay đổi của swarm không ghi được vào DB (xem apply_batch), báo qua STATS
+
+# Upsert một câu lệnh, dựa trên unique index idx_nodes_ip_port / idx_files_info_hash (xem init_db)
+UPSERT_NODE = """
+    INSERT INTO Nodes (ip_address, port, last_seen) VALUES (?, ?, strftime('%s', 'now'))
+    ON CONFLICT (ip_address, port) DO NOTHING
+"""
+UPSERT_FILE = """
+    INSERT INTO Files (file_name, total_piece, magnet_link, info_hash) VALUES (?, ?, ?, ?)
+    ON CONFLICT (info_hash) DO NOTHING
+"""
+UPSERT_PIECE = """
+    INSERT INTO Pieces (file_id, piece_index)
+    SELECT fid, ? FROM Files WHERE info_hash = ?
+    ON CONFLICT (file_id, piece_index) DO NOTHING
+"""
+LINK_PIECE_TO_NODE = """
+    INSERT INTO PiecesNodes (piece_id, node_id)
+    SELECT Pieces.pid, Nodes.nid FROM Pieces JOIN Files ON Pieces.file_id = Files.fid, Nodes
+    WHERE Pieces.piece_index = ? AND Files.info_hash = ? AND Nodes.ip_address = ? AND Nodes.port = ?
+    ON CONFLICT (piece_id, node_id) DO NOTHING
+"""
+# Node rút lại mọi piece đã báo của một file (HAVE_PIECES với bitfield rỗng)
+DROP_PIECES_OF_NODE = """
+    DELETE FROM PiecesNodes
+    WHERE node_id = (SELECT nid FROM Nodes WHERE ip_address = ? AND port = ?)
+      AND piece_id IN (SELECT Pieces.pid FROM Pieces JOIN Files ON Pieces.file_id = Files.fid WHERE Files.info_hash = ?)
+"""
+LINK_FILE_TO_NODE = """
+    INSERT INTO NodesFiles (file_id, node_id)
+    SELECT Files.fid, Nodes.nid FROM Files, Nodes
+    WHERE Files.info_hash = ? AND Nodes.ip_address = ? AND Nodes.port = ?
+    ON CONFLICT (file_id, node_id) DO NOTHING
+"""
+# Một piece đã chuyển xong; bỏ qua (không lỗi) nếu node hay file không còn trong DB
+INSERT_TRANSFER = """
+    INSERT INTO Transactions (download_node, upload_node, file_id, piece_id, bytes, created_at)
+    SELECT down.nid, up.nid, Files.fid, Pieces.pid, ?, strftime('%s', 'now')
+    FROM Nodes down, Nodes up, Files JOIN Pieces ON Pieces.file_id = Files.fid
+    WHERE down.ip_address = ? AND down.port = ? AND up.ip_address = ? AND up.port = ?
+      AND Files.info_hash = ? AND Pieces.piece_index = ?
+"""
 
 '''Các hàm liên quan đến database'''
 def connect_db():
-    return sqlite3.connect('tracker.db')
-
-def register_node(peer_ip, peer_port):
-    try:
-        conn = connect_db()
-        cursor = conn.cursor()
-
-        # Check if the node already exists
-        cursor.execute("SELECT COUNT(*) FROM Nodes WHERE ip_address = ? AND port = ?", (peer_ip, peer_port))
-        if cursor.fetchone()[0] > 0:
-            print(f"Node with IP {peer_ip} and port {peer_port} already exists.")
-            return
-
-        # Insert the node if it doesn't exist
-        cursor.execute("INSERT INTO Nodes (ip_address, port) VALUES (?, ?)", (peer_ip, peer_port))
-        conn.commit()
-        print(f"Node with IP {peer_ip} and port {peer_port} registered successfully.")
-    except Exception as e:
-        print(f"Error in register_node: {e}")
-    finally:
-        conn.close()
-
-def remove_node(peer_ip, peer_port):
-    try:
-        conn = connect_db()
-        cursor = conn.cursor()
-
-        # Check if the node exists
-        cursor.execute("SELECT COUNT(*) FROM Nodes WHERE ip_address = ? AND port = ?", (peer_ip, peer_port))
-        if cursor.fetchone()[0] == 0:
-            print(f"Node with IP {peer_ip} and port {peer_port} does not exist.")
-            return
-
-        # Remove the node if it exists
-
-
-        cursor.execute("SELECT nid FROM Nodes WHERE ip_address = ? AND port = ?", (peer_ip, peer_port))
-        nid = cursor.fetchone()[0]
-
-        cursor.execute("DELETE FROM NodesFiles WHERE node_id = ?", (nid,))
-        cursor.execute("DELETE FROM Nodes WHERE ip_address = ? AND port = ?", (peer_ip, peer_port))
-        conn.commit()
-        print(f"Node with IP {peer_ip} and port {peer_port} removed successfully.")
-
-
-    except Exception as e:
-        print(f"Error in remove_node: {e}")
-    finally:
+    """
+    Return the SQLite connection of the calling thread, opening it on first use.
+
+    Each worker thread keeps one connection for its whole life instead of opening
+    and closing one per command, so the statement cache of the connection
+    (prepared statements keyed by SQL text) is actually reused. The connection
+    runs in autocommit mode; transactions are opened explicitly by transaction().
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_NAME, isolation_level=None, timeout=5,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode=WAL")      # Reader không chặn writer và ngược lại
+        conn.execute("PRAGMA synchronous=NORMAL")    # Đủ an toàn với WAL, bớt fsync mỗi commit
+        _local.conn = conn
+    return conn
+
+def close_db():
+    """
+    Close the connection of the calling thread, if any.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
         conn.close()
+        _local.conn = None
 
+@contextmanager
+def transaction(write=True):
+    """
+    Run a block of statements as one explicit transaction on this thread's connection.
 
-def register_file(file_name, total_piece, node_ip, node_port, magnet_link):
-    try:
-        conn = connect_db()
-        cursor = conn.cursor()
-
-        # Kiểm tra file đã tồn tại chưa
-        cursor.execute("SELECT COUNT(*) FROM Files WHERE file_name = ?", (file_name,))
-
-        # Đã tồn tại file -> Nhiều Node có file đó.
-        if cursor.fetchone()[0] > 0:
-            # Tìm node ID dựa trên IP và port
-            cursor.execute("SELECT nid FROM Nodes WHERE ip_address = ? AND port = ?", (node_ip, node_port))
-            node = cursor.fetchone()
-            if not node:
-                return "Node not found."
-
-            nid = node[0]
-            add_file_to_node(nid, file_name)
-
-            return "File registered and added to the node!"
-
-        else:
-            # Thêm file mới vào bảng Files
-            cursor.execute('''
-            INSERT INTO Files (file_name, total_piece, magnet_link) 
-            VALUES (?, ?, ?)
-            ''', (file_name, total_piece, magnet_link))
-            conn.commit()
-
-            # Tìm node ID dựa trên IP và port
-            cursor.execute("SELECT nid FROM Nodes WHERE ip_address = ? AND port = ?", (node_ip, node_port))
-            node = cursor.fetchone()
-            if not node:
-                return "Node not found."
-
-            nid = node[0]
-            add_file_to_node(nid, file_name)
-
-            return "File registered and added to the node!"
-    except Exception as e:
-        print(f"Error in register_file: {e}")
-        return "Error registering file."
-    finally:
-        conn.close()
-
+    Args:
+        write (bool): Take the write lock up front (BEGIN IMMEDIATE) so two writers
+            never deadlock trying to upgrade a read lock.
 
-def add_file_to_node(nid, file_name):
+    Yields:
+        sqlite3.Cursor: Cursor to run the statements with.
+    """
     conn = connect_db()
     cursor = conn.cursor()
-
-    # Get the file ID based on the file name
-    cursor.execute("SELECT fid FROM Files WHERE file_name = ?", (file_name,))
-    file = cursor.fetchone()
-    if not file:
-        print(f"File {file_name} not found.")
-        conn.close()
-        return
-
-    fid = file[0]
-
-    # Insert the record into the NodesFiles table
+    cursor.execute("BEGIN IMMEDIATE" if write else "BEGIN")
     try:
-        cursor.execute("INSERT INTO NodesFiles (file_id, node_id) VALUES (?, ?)", (fid, nid))
+        yield cursor
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
         conn.commit()
-        print(f"Added file {file_name} (fid: {fid}) to node (nid: {nid}).")
-    except sqlite3.IntegrityError:
-        print(f"File {file_name} (fid: {fid}) is already associated with node (nid: {nid}).")
-    finally:
-        conn.close()
 
-#Returns (ip, port) of nodes holding the file
-def get_nodes_has_file(file_name):
-    try:
-        conn = connect_db()
-        cursor = conn.cursor()
-
-        # Get the file ID based on the file name
-        cursor.execute("SELECT fid FROM Files WHERE file_name = ?", (file_name,))
-        file = cursor.fetchone()
-        if not file:
-            raise ValueError("File not found.")
-        
-        fid = file[0]
-
-        # Query to find nodes holding the requested file
+def load_swarm():
+    """
+    Read the persisted swarm, used by swarm.load_from_db on a warm restart.
+
+    Returns:
+        tuple: (nodes [(ip, port)], files [(file_name, total_piece, magnet_link, info_hash)],
+        links [(ip, port, info_hash)], pieces [(ip, port, info_hash, piece_index)]).
+    """
+    with stats.timed("load_swarm"), transaction(write=False) as cursor:
+        cursor.execute("SELECT ip_address, port FROM Nodes")
+        nodes = cursor.fetchall()
+        cursor.execute("SELECT file_name, total_piece, magnet_link, info_hash FROM Files WHERE info_hash IS NOT NULL")
+        files = cursor.fetchall()
         cursor.execute("""
-            SELECT Nodes.ip_address, Nodes.port 
+            SELECT Nodes.ip_address, Nodes.port, Files.info_hash
             FROM NodesFiles
             JOIN Nodes ON NodesFiles.node_id = Nodes.nid
-            WHERE NodesFiles.file_id = ?
-        """, (fid,))
-        nodes = cursor.fetchall()
-
-        if (not nodes):
-            raise ValueError("No nodes have the requested file " + file_name + " fid: " + str(fid))
-
-        # Query to find the magnet link and total pieces for the requested file
-        cursor.execute("SELECT magnet_link, total_piece FROM Files WHERE fid = ?", (fid,))
-        query = cursor.fetchone()
+            JOIN Files ON NodesFiles.file_id = Files.fid
+            WHERE Files.info_hash IS NOT NULL
+        """)
+        links = cursor.fetchall()
+        cursor.execute("""
+            SELECT Nodes.ip_address, Nodes.port, Files.info_hash, Pieces.piece_index
+            FROM PiecesNodes
+            JOIN Nodes ON PiecesNodes.node_id = Nodes.nid
+            JOIN Pieces ON PiecesNodes.piece_id = Pieces.pid
+            JOIN Files ON Pieces.file_id = Files.fid
+            WHERE Files.info_hash IS NOT NULL
+        """)
+        pieces = cursor.fetchall()
+    return nodes, files, links, pieces
+
+def _apply_op(cursor, op):
+    kind, (peer_ip, peer_port) = op[0], op[1]
+
+    if kind == "REGISTER_NODE":
+        cursor.execute(UPSERT_NODE, (peer_ip, peer_port))
+
+    elif kind == "ANNOUNCE":
+        cursor.execute("UPDATE Nodes SET last_seen = ? WHERE ip_address = ? AND port = ?",
+                       (op[2], peer_ip, peer_port))
+
+    elif kind == "REGISTER_FILE":
+        _, _, file_name, total_piece, magnet_link, info_hash = op
+        cursor.execute(UPSERT_FILE, (file_name, total_piece, magnet_link, info_hash))
+        cursor.execute(LINK_FILE_TO_NODE, (info_hash, peer_ip, peer_port))
+
+    elif kind == "REGISTER_FILES":
+        file_list = op[2]
+        cursor.executemany(UPSERT_FILE, file_list)
+        cursor.executemany(LINK_FILE_TO_NODE, [(f[3], peer_ip, peer_port) for f in file_list])
+
+    elif kind == "HAVE_PIECES":
+        _, _, info_hash, piece_indices = op
+        cursor.executemany(UPSERT_PIECE, [(index, info_hash) for index in piece_indices])
+        cursor.executemany(LINK_PIECE_TO_NODE,
+                           [(index, info_hash, peer_ip, peer_port) for index in piece_indices])
+
+    elif kind == "DROP_PIECES":
+        cursor.execute(DROP_PIECES_OF_NODE, (peer_ip, peer_port, op[2]))
+
+    elif kind == "TRANSFERS":
+        # (ip, port) là node tải về, mỗi dòng là một piece nhận từ node upload
+        transfers = op[2]
+        cursor.executemany(UPSERT_PIECE, [(index, info_hash) for _, _, info_hash, index, _ in transfers])
+        cursor.executemany(INSERT_TRANSFER, [
+            (size, peer_ip, peer_port, upload_ip, upload_port, info_hash, index)
+            for upload_ip, upload_port, info_hash, index, size in transfers
+        ])
+
+    elif kind == "REMOVE_NODE":
+        cursor.execute("SELECT nid FROM Nodes WHERE ip_address = ? AND port = ?", (peer_ip, peer_port))
+        node = cursor.fetchone()
+        if node:
+            cursor.execute("DELETE FROM NodesFiles WHERE node_id = ?", (node[0],))
+            cursor.execute("DELETE FROM PiecesNodes WHERE node_id = ?", (node[0],))
+            cursor.execute("DELETE FROM Nodes WHERE nid = ?", (node[0],))
+
+def apply_batch(ops):
+    """
+    Persist a batch of swarm changes queued by swarm.py in one transaction.
+
+    Args:
+        ops (list): Tuples ("REGISTER_NODE", (ip, port)),
+            ("REGISTER_FILE", (ip, port), file_name, total_piece, magnet_link, info_hash),
+            ("REGISTER_FILES", (ip, port), [(file_name, total_piece, magnet_link, info_hash), ...]),
+            ("ANNOUNCE", (ip, port), timestamp),
+            ("HAVE_PIECES", (ip, port), info_hash, [piece_index, ...]),
+            ("DROP_PIECES", (ip, port), info_hash),
+            ("TRANSFERS", (ip, port), [(upload_ip, upload_port, info_hash, piece_index, bytes), ...])
+            or ("REMOVE_NODE", (ip, port)).
+
+    Each op runs under its own savepoint: an op that fails is rolled back alone,
+    logged and counted in dropped_ops, and the rest of the batch is still committed.
+    """
+    global dropped_ops
+    dropped = 0
+    try:
+        with stats.timed("apply_batch"), transaction() as cursor:
+            for op in ops:
+                cursor.execute("SAVEPOINT batch_op")
+                try:
+                    _apply_op(cursor, op)
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO batch_op")
+                    dropped += 1
+                    print(f"Error in apply_batch, dropped {op[0]} of {op[1]}: {e}")
+                finally:
+                    cursor.execute("RELEASE batch_op")
+    except Exception as e:
+        # Không mở/commit được transaction (vd. DB bị khóa quá timeout): mất cả batch
+        dropped = len(ops)
+        print(f"Error in apply_batch, dropped {len(ops)} ops: {e}")
+    dropped_ops += dropped
+
+def swarm_analytics(limit=10):
+    """
+    Aggregate the recorded piece transfers, for capacity planning.
+
+    Top uploaders only list nodes still registered. A node that has left keeps
+    its rows in Transactions, but its address left with its Nodes row. nids are
+    never reused (AUTOINCREMENT, see init_db), so a new node does not inherit them.
+
+    Returns:
+        dict: {"totals": {"transfers", "bytes"},
+               "top_uploaders": [{"node": "ip:port", "bytes", "pieces"}],
+               "swarms": [{"file_name", "info_hash", "bytes", "pieces", "downloaders"}],
+               "completions": [{"file_name", "info_hash", "completed"}]}
+        The lists are sorted by decreasing bytes / completed and cut at `limit`.
+    """
+    with stats.timed("swarm_analytics"), transaction(write=False) as cursor:
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM Transactions")
+        transfers, total_bytes = cursor.fetchone()
 
-        if query:
-            magnet_link, total_piece = query
-        else:
-            raise ValueError("File not found.")
+        cursor.execute("""
+            SELECT Nodes.ip_address, Nodes.port, SUM(t.bytes), COUNT(*)
+            FROM Transactions t JOIN Nodes ON t.upload_node = Nodes.nid
+            GROUP BY t.upload_node ORDER BY 3 DESC LIMIT ?
+        """, (limit,))
+        uploaders = [{"node": f"{ip}:{port}", "bytes": size, "pieces": pieces}
+                     for ip, port, size, pieces in cursor.fetchall()]
 
-        return {"nodes": nodes, "magnet_link": magnet_link, "total_piece": total_piece}
-    except Exception as e:
-        print(f"Error in get_nodes_has_file: {e}")
-    finally:
-        conn.close()
+        cursor.execute("""
+            SELECT Files.file_name, Files.info_hash, SUM(t.bytes), COUNT(*), COUNT(DISTINCT t.download_node)
+            FROM Transactions t JOIN Files ON t.file_id = Files.fid
+            GROUP BY t.file_id ORDER BY 3 DESC LIMIT ?
+        """, (limit,))
+        swarms = [{"file_name": name, "info_hash": info_hash, "bytes": size, "pieces": pieces, "downloaders": downloaders}
+                  for name, info_hash, size, pieces, downloaders in cursor.fetchall()]
+
+        # Một lượt tải hoàn tất = một node tải về đã nhận đủ total_piece piece khác nhau của file
+        cursor.execute("""
+            SELECT Files.file_name, Files.info_hash, COUNT(*)
+            FROM (
+                SELECT file_id, download_node, COUNT(DISTINCT piece_id) AS pieces
+                FROM Transactions GROUP BY file_id, download_node
+            ) AS received JOIN Files ON received.file_id = Files.fid
+            WHERE received.pieces >= Files.total_piece
+            GROUP BY received.file_id ORDER BY 3 DESC LIMIT ?
+        """, (limit,))
+        completions = [{"file_name": name, "info_hash": info_hash, "completed": completed}
+                       for name, info_hash, completed in cursor.fetchall()]
+
+    return {"totals": {"transfers": transfers, "bytes": total_bytes},
+            "top_uploaders": uploaders, "swarms": swarms, "completions": completions}
 
 '''DEBUG FUNCTIONS'''
-def print_nodes():
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Nodes")
+def _print_query(query):
+    cursor = connect_db().cursor()
+    cursor.execute(query)
     print(cursor.fetchall())
-    conn.close()
+
+def print_nodes():
+    _print_query("SELECT * FROM Nodes")
 
 def print_files():
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Files")
-    print(cursor.fetchall())
-    conn.close()
+    _print_query("SELECT * FROM Files")
 
 def print_pieces():
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Pieces")
-    print(cursor.fetchall())
-    conn.close()
+    _print_query("SELECT * FROM Pieces")
 
 def print_pieces_nodes():
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM PiecesNodes")
-    print(cursor.fetchall())
-    conn.close()
+    _print_query("SELECT * FROM PiecesNodes")
 
 def print_nodes_files():
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT node_id, file_id FROM NodesFiles")
-    print(cursor.fetchall())
-    conn.close()
\ No newline at end of file
+    _print_query("SELECT node_id, file_id FROM NodesFiles")
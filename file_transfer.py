@@ -4,10 +4,24 @@ import socket
 import json
 import threading
 import urllib.parse
+from collections import deque
 from time import sleep
 
 import concurrent.futures
-PIECESIZE = 1024
+import protocol as proto
+PIECESIZE = 1024                # Piece size của magnet link cũ (không có &ps=)
+MIN_PIECE_SIZE = 16 * 1024
+MAX_PIECE_SIZE = 4 * 1024 * 1024
+TARGET_PIECES = 1024            # Số piece nhắm tới cho mỗi file, xem piece_size_for()
+PIPELINE_WINDOW = 8             # Số REQUEST_PIECE gửi trước (chưa có reply) trên mỗi connection tới peer
+DOWNLOAD_WORKERS = 8            # Kích thước worker pool của mỗi lượt tải = số peer tải song song
+BATCH_PIECES = 32               # Số piece một worker nhận từ hàng đợi cho một peer mỗi lần
+MAX_PIECE_ATTEMPTS = 3          # Số peer khác nhau được thử cho một piece trước khi bỏ
+CONNECT_TIMEOUT = 3     # Giây chờ kết nối tới peer, peer chết thì bỏ qua nhanh
+PROGRESS_INTERVAL = 2   # Giây giữa 2 lần báo tiến độ (on_progress) khi đang tải
+
+partial_files = {}      # Đường dẫn file đang tải -> PartialFile, xem read_piece()
+partial_lock = threading.Lock()
 
 '''
 Debug functions
@@ -29,6 +43,7 @@ def get_ephemeral_socket(Node_ip, Node_port):
     """
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client_socket.bind(("", 0))  # Bind to an ephemeral port
+    client_socket.settimeout(CONNECT_TIMEOUT)
     client_socket.connect((Node_ip, Node_port))
     client_socket.settimeout(20)
     return client_socket
@@ -46,13 +61,15 @@ def generate_magnet_link(file_name, pieces_metadata):
         pieces_metadata (list): Metadata of all pieces (list of hashes or similar info).
 
     Returns:
-        str: Magnet link for the file.
+        str: Magnet link for the file, with the piece size as &ps=<bytes>.
     """
     # Concatenate piece hashes to compute the file's info_hash
     info_hash = hashlib.sha1("".join(p['piece_hash'] for p in pieces_metadata).encode()).hexdigest()
 
     # Build the magnet link
     magnet_link = f"magnet:?xt=urn:btih:{info_hash}&dn={file_name}"
+    if pieces_metadata and "piece_size" in pieces_metadata[0]:
+        magnet_link += f"&ps={pieces_metadata[0]['piece_size']}"
     return magnet_link
 
 def decode_magnet_link(magnet_link):        # Terminated
@@ -62,22 +79,34 @@ def decode_magnet_link(magnet_link):        # Terminated
     parsed_url = urllib.parse.urlparse(magnet_link)
     query_params = urllib.parse.parse_qs(parsed_url.query)
 
-    # Extract the info_hash and file_name (dn)
-    info_hash = parsed_url.path.split(":")[-1]
+    # Extract the info_hash (xt), file_name (dn) and piece size (ps)
+    info_hash = query_params.get("xt", [""])[0].split(":")[-1]
     file_name = query_params.get("dn", ["Unknown"])[0]
+    piece_size = int(query_params.get("ps", [PIECESIZE])[0])
 
-    return {"info_hash": info_hash, "file_name": file_name}
+    return {"info_hash": info_hash, "file_name": file_name, "piece_size": piece_size}
 
-def split_file(file_name, piece_size=PIECESIZE):  # Default piece size = 1 MB
+def piece_size_for(file_size):
+    """
+    Piece size for a file: the smallest power of two between MIN_PIECE_SIZE and
+    MAX_PIECE_SIZE that keeps the file at about TARGET_PIECES pieces or fewer.
+    A 100 MB file gets 128 KiB pieces (~800 pieces) instead of 100k 1 KiB pieces.
+    """
+    piece_size = MIN_PIECE_SIZE
+    while piece_size < MAX_PIECE_SIZE and piece_size * TARGET_PIECES < file_size:
+        piece_size *= 2
+    return piece_size
+
+def split_file(file_name, piece_size=None):
     """
     Splits a file into pieces and generates metadata for each piece.
 
     Args:
         file_name (str): Name of the file to be split.
-        piece_size (int): Size of each piece in bytes.
+        piece_size (int): Size of each piece in bytes. Default: piece_size_for(file size).
 
     Returns:
-        list: Metadata of pieces, including hashes and indices.
+        list: Metadata of pieces, including hashes, indices and the piece size.
     """
     file_path = os.path.join(os.getcwd(), file_name)  # Construct file path in the current directory
 
@@ -85,6 +114,7 @@ def split_file(file_name, piece_size=PIECESIZE):  # Default piece size = 1 MB
         raise FileNotFoundError(f"File not found: {file_path}")
     
     file_size = os.path.getsize(file_path)
+    piece_size = piece_size or piece_size_for(file_size)
     total_pieces = (file_size + piece_size - 1) // piece_size  # Calculate number of pieces
     
     metadata = []  # Store metadata for each piece
@@ -95,6 +125,7 @@ def split_file(file_name, piece_size=PIECESIZE):  # Default piece size = 1 MB
             metadata.append({
                 "file_name": file_name,
                 "piece_index": index,
+                "piece_size": piece_size,
                 "piece_hash": piece_hash
             })
     
@@ -116,13 +147,11 @@ def find_file(tracker_ip, tracker_port, file_name):
 
         # Send FIND_FILE request
         request = f"FIND_FILE {file_name}"
-        client_socket.sendall(request.encode())
+        msg_type, payload = proto.request(client_socket, request)
         print(f"Sent request: {request}")
 
         # Receive and parse the response
-        response = client_socket.recv(4096).decode("utf-8")
-        response_json = json.loads(response)
-        return response_json
+        return parse_find_reply(msg_type, payload)
 
     except socket.error as e:
         print(f"Error connecting to tracker: {e}")
@@ -142,6 +171,9 @@ def parse_find_file_response(response):
         nodes = response_json.get("nodes", [])
         magnet_link = response_json.get("magnet_link")
         total_piece = response_json.get("total_piece")
+        bitfields = response_json.get("bitfields", {})
+        file_name = response_json.get("file_name")
+        info_hash = response_json.get("info_hash")
 
         print(f"Nodes: {nodes}")
         print(f"Magnet link: {magnet_link}")
@@ -158,53 +190,413 @@ def parse_find_file_response(response):
 
         return {
             "nodes": nodes,
+            "file_name": file_name,
+            "info_hash": info_hash,
             "magnet_link": magnet_link,
-            "total_piece": total_piece
+            "total_piece": total_piece,
+            "bitfields": bitfields
         } #Học thêm về python JSON
     except json.JSONDecodeError:
         print("Error decoding server response. Raw response:")
         print(response)
         return None
 
-def download_piece(piece_index, peer_ip, peer_port, file_name, save_path):
+def parse_find_reply(msg_type, payload):
+    """
+    Decode the tracker reply to FIND_FILE, in either JSON or compact (MSG_COMPACT) form.
+    Returns:
+        dict: {"nodes", "file_name", "info_hash", "magnet_link", "total_piece", "bitfields"},
+        or None if the tracker answered with an error.
+    """
+    if msg_type == proto.MSG_JSON:
+        return parse_find_file_response(proto.decode_text(payload))
+
+    if msg_type == proto.MSG_COMPACT:
+        meta, blob = proto.decode_compact(payload)
+        response_json = proto.unpack_swarm(meta, blob)
+        # Không in từng node: với swarm lớn việc in chiếm phần lớn thời gian parse
+        print(f"Magnet link: {response_json['magnet_link']}")
+        print(f"Total pieces: {response_json['total_piece']}")
+        print(f"Nodes with the requested file: {len(response_json['nodes'])}")
+        return response_json
+
+    print(f"Server response: {proto.decode_text(payload)}")
+    return None
+
+def parse_find_files_reply(msg_type, payload):
+    """
+    Decode the tracker reply to FIND_FILES, in either JSON or compact form.
+    Returns:
+        dict: file_name -> swarm dict, or None for files nobody has.
+    """
+    if msg_type == proto.MSG_JSON:
+        return json.loads(proto.decode_text(payload))["files"]
+
+    if msg_type == proto.MSG_COMPACT:
+        meta, blob = proto.decode_compact(payload)
+        return {key: proto.unpack_swarm(info, blob) if info else None for key, info in meta["files"].items()}
+
+    print(f"Server response: {proto.decode_text(payload)}")
+    return {}
+
+class PeerSession:
+    """
+    One long-lived connection to a peer, used for every piece fetched from it
+    instead of a new TCP connection (handshake + slow start) per piece.
+
+    Up to `window` REQUEST_PIECE are in flight at once: a new request goes out as
+    soon as a reply comes back, so the link does not sit idle for a round-trip
+    between pieces. The peer serves one connection in order (handle_income_request),
+    so replies come back in the order of the requests.
+    """
+
+    def __init__(self, peer_ip, peer_port, window=None):
+        self.peer_ip = peer_ip
+        self.peer_port = peer_port
+        self.window = max(1, window or PIPELINE_WINDOW)
+        self.sock = get_ephemeral_socket(peer_ip, peer_port)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)   # Request nhỏ, gửi ngay
+
+    def fetch(self, file_name, piece_indices, piece_size, on_piece):
+        """
+        Download the given pieces over this connection.
+
+        Args:
+            on_piece (callable): on_piece(piece_index, data) for each piece received.
+                `data` is a memoryview only valid during the call.
+
+        Returns:
+            list: Indices the peer answered with an error.
+        Raises:
+            OSError: If the connection breaks; pieces not passed to on_piece yet are lost.
+        """
+        buffer = bytearray(piece_size)
+        waiting = deque(piece_indices)
+        in_flight = deque()
+        failed = []
+
+        while waiting or in_flight:
+            # Bù cho đủ cửa sổ, các request đi chung một lần sendall
+            frames = []
+            while waiting and len(in_flight) < self.window:
+                piece_index = waiting.popleft()
+                frames.append(proto.encode_frame(proto.MSG_COMMAND, f"REQUEST_PIECE {file_name} {piece_index} {piece_size}"))
+                in_flight.append(piece_index)
+            if frames:
+                self.sock.sendall(b"".join(frames))
+
+            piece_index = in_flight.popleft()
+            msg_type, data = proto.recv_frame(self.sock, buffer)
+            if msg_type is None:
+                raise ConnectionError(f"{self.peer_ip}:{self.peer_port} closed the connection")
+            if msg_type == proto.MSG_PIECE and data:
+                on_piece(piece_index, data)
+            else:
+                print(f"Failed to download piece {piece_index} from {self.peer_ip}:{self.peer_port}: {proto.decode_text(data)}")
+                failed.append(piece_index)
+        return failed
+
+    def close(self):
+        self.sock.close()
+
+class DownloadScheduler:
+    """
+    Download the pieces of one file with a fixed pool of `workers` threads,
+    whatever the number of pieces or peers.
+
+    Pieces wait in a shared work queue. A free worker claims a peer nobody is
+    using, takes up to BATCH_PIECES queued pieces that peer holds and fetches them
+    over one PeerSession, so a peer never has more than one connection and
+    `window` requests in flight. Faster peers come back for more batches sooner.
+    A piece that fails goes back to the queue and is not asked from the same
+    peer again; a peer that cannot be reached is dropped.
+    """
+
+    def __init__(self, file_name, nodes, bitfields, total_pieces, piece_size, on_piece, workers=None, window=None):
+        """
+        Args:
+            on_piece (callable): on_piece(piece_index, peer_ip, peer_port, data) for each
+                piece received; `data` is a memoryview only valid during the call.
+        """
+        self.file_name = file_name
+        self.peers = [tuple(node) for node in nodes]
+        self.bitfields = {peer: bitfields.get(f"{peer[0]}:{peer[1]}") for peer in self.peers}
+        # Piece không ai được biết là có -> thử mọi peer, giống piece_holders(). Tính một lần ở đây,
+        # không tính lại cho từng (peer, piece) trong _claim()
+        if any(bitfield is None for bitfield in self.bitfields.values()):
+            self.unheld = set()
+        else:
+            held = set()
+            for bitfield in self.bitfields.values():
+                held.update(proto.bitfield_indices(bitfield))
+            self.unheld = set(range(total_pieces)) - held
+        self.piece_size = piece_size
+        self.on_piece = on_piece
+        self.workers = max(1, workers or DOWNLOAD_WORKERS)
+        self.window = window
+
+        self.queue = deque(range(total_pieces))
+        self.tried = {}         # piece_index -> set các peer đã tải hỏng piece này
+        self.busy = set()       # Peer đang có một worker tải
+        self.dead = set()       # Peer không kết nối được
+        self.next_peer = 0      # Xoay vòng điểm bắt đầu chọn peer
+        self.condition = threading.Condition()
+
+    def _holds(self, peer, piece_index):
+        return proto.has_piece(self.bitfields[peer], piece_index) or piece_index in self.unheld
+
+    def _claim(self):
+        """
+        Pick an idle peer and take a batch of its pieces off the queue.
+        Called with self.condition held. Returns (peer, [piece_index]) or (None, None).
+        """
+        for offset in range(len(self.peers)):
+            peer = self.peers[(self.next_peer + offset) % len(self.peers)]
+            if peer in self.busy or peer in self.dead:
+                continue
+
+            batch, skipped = [], []
+            while self.queue and len(batch) < BATCH_PIECES:
+                piece_index = self.queue.popleft()
+                if peer not in self.tried.get(piece_index, ()) and self._holds(peer, piece_index):
+                    batch.append(piece_index)
+                else:
+                    skipped.append(piece_index)
+            self.queue.extendleft(reversed(skipped))
+
+            if batch:
+                self.busy.add(peer)
+                self.next_peer = (self.next_peer + offset + 1) % len(self.peers)
+                return peer, batch
+        return None, None
+
+    def _release(self, peer, batch, done, reachable):
+        # Trả các piece chưa tải được về hàng đợi, trừ khi đã thử đủ MAX_PIECE_ATTEMPTS peer
+        self.busy.discard(peer)
+        if not reachable:
+            self.dead.add(peer)
+        for piece_index in batch:
+            if piece_index in done:
+                continue
+            tried = self.tried.setdefault(piece_index, set())
+            tried.add(peer)
+            if len(tried) < MAX_PIECE_ATTEMPTS:
+                self.queue.append(piece_index)
+
+    def _finish(self, peer, batch, done, reachable):
+        with self.condition:
+            self._release(peer, batch, done, reachable)
+            self.condition.notify_all()
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                peer, batch = self._claim()
+                while peer is None:
+                    if not self.busy:
+                        return      # Hết piece, hoặc không còn peer nào tải được các piece còn lại
+                    self.condition.wait()   # Worker khác có thể trả piece về hàng đợi
+                    peer, batch = self._claim()
+
+            done = set()
+            reachable = True
+            def save(piece_index, piece_data):
+                self.on_piece(piece_index, peer[0], peer[1], piece_data)
+                done.add(piece_index)
+
+            session = None
+            try:
+                session = PeerSession(peer[0], peer[1], self.window)
+                session.fetch(self.file_name, batch, self.piece_size, save)
+            except Exception as e:
+                print(f"Error downloading from {peer[0]}:{peer[1]}: {e}")
+                reachable = session is not None
+            finally:
+                if session:
+                    session.close()
+                self._finish(peer, batch, done, reachable)
+
+    def run(self, on_tick=None):
+        """
+        Download until every piece is done or cannot be downloaded, calling
+        on_tick() every PROGRESS_INTERVAL seconds meanwhile.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="download") as pool:
+            futures = [pool.submit(self._worker) for _ in range(self.workers)]
+            while concurrent.futures.wait(futures, timeout=PROGRESS_INTERVAL).not_done:
+                if on_tick:
+                    on_tick()
+
+class PartialFile:
     """
-    Tải một mảnh từ peer.
+    Output of a download in progress: <file_name>.partial, preallocated to
+    total_pieces * piece_size. Each piece is written at its offset as soon as
+    it arrives; commit() trims the file to its real size and renames it to
+    <file_name>, so the complete name never holds a partial file.
+    Registered in partial_files while open, so read_piece can upload the pieces
+    already written.
+
+    Raises:
+        FileExistsError: Another download of the same file is in progress.
     """
-    download_socket = get_ephemeral_socket(peer_ip, peer_port)
+
+    def __init__(self, save_path, file_name, total_pieces, piece_size):
+        self.file_path = os.path.join(save_path, file_name)
+        self.path = self.file_path + ".partial"
+        self.key = os.path.abspath(self.file_path)
+        self.piece_size = piece_size
+        self.pieces = set()     # Các piece đã ghi xong
+        self.size = 0           # Cuối piece xa nhất đã ghi = kích thước thật khi đủ piece
+        self.lock = threading.Lock()
+        self.fd = None
+
+        # Giữ tên trước khi mở: lượt tải thứ hai cùng tên không được O_TRUNC file đang ghi
+        with partial_lock:
+            if self.key in partial_files:
+                raise FileExistsError(f"{self.file_path} is already being downloaded.")
+            partial_files[self.key] = self
+
+        length = total_pieces * piece_size
+        try:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+            # File rỗng (0 piece): không có gì để giữ chỗ, posix_fallocate(len=0) báo EINVAL
+            if length > 0 and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(self.fd, 0, length)  # Giữ chỗ trên đĩa ngay, hết chỗ thì lỗi từ đầu
+            elif length > 0:
+                os.ftruncate(self.fd, length)
+        except OSError:
+            self.discard()
+            raise
+
+    def _write_at(self, data, offset):
+        view = memoryview(data)
+        while view:
+            if hasattr(os, "pwrite"):
+                written = os.pwrite(self.fd, view, offset)
+            else:
+                # Không có pwrite (Windows): seek + write phải đi liền nhau
+                with self.lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    written = os.write(self.fd, view)
+            view = view[written:]
+            offset += written
+
+    def write(self, piece_index, piece_data):
+        offset = piece_index * self.piece_size
+        self._write_at(piece_data, offset)
+        with self.lock:
+            self.pieces.add(piece_index)
+            self.size = max(self.size, offset + len(piece_data))
+
+    def read(self, piece_index):
+        """
+        Returns:
+            bytes: The piece, or None if it has not been written yet.
+        """
+        # Giữ lock khi đọc để commit()/discard() không đóng fd giữa chừng
+        with self.lock:
+            if piece_index not in self.pieces or self.fd is None:
+                return None
+            offset = piece_index * self.piece_size
+            length = min(self.piece_size, self.size - offset)
+            if hasattr(os, "pread"):
+                return os.pread(self.fd, length, offset)
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, length)
+
+    def have(self):
+        with self.lock:
+            return sorted(self.pieces)
+
+    def _close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def _release(self):
+        # Chỉ nhả tên sau khi đã đổi tên/xóa .partial, để lượt tải mới không mở lại file này
+        with partial_lock:
+            if partial_files.get(self.key) is self:
+                del partial_files[self.key]
+
+    def trim(self):
+        # Bỏ phần cấp dư ở cuối (piece cuối thường ngắn hơn piece_size)
+        os.ftruncate(self.fd, self.size)
+
+    def commit(self):
+        self.trim()
+        self._close()
+        try:
+            os.replace(self.path, self.file_path)
+        finally:
+            self._release()
+
+    def discard(self):
+        self._close()
+        try:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        finally:
+            self._release()
+
+def write_piece(save_path, file_name, piece_index, piece_data):
+    # Ghi mảnh vào file .partial của lượt tải đang chạy
+    with partial_lock:
+        partial = partial_files[os.path.abspath(os.path.join(save_path, file_name))]
+    partial.write(piece_index, piece_data)
+
+def download_piece(piece_index, peer_ip, peer_port, file_name, save_path, piece_size=PIECESIZE):
+    """
+    Tải một mảnh từ peer. piece_size lấy từ magnet link (&ps=) và được gửi kèm
+    REQUEST_PIECE để peer cắt đúng mảnh.
+    Returns:
+        int: Số byte đã nhận (> 0), hoặc False nếu tải không được.
+    """
+    download_socket = None
     try:
         print(f"Downloading piece {piece_index} from {peer_ip}:{peer_port}...")
+        download_socket = get_ephemeral_socket(peer_ip, peer_port)
 
 
         # Yêu cầu mảnh từ peer
-        request = f"REQUEST_PIECE {file_name} {piece_index}"
-        download_socket.sendall(request.encode('utf-8'))
+        request = f"REQUEST_PIECE {file_name} {piece_index} {piece_size}"
         
-        # Nhận dữ liệu mảnh
-        piece_data = download_socket.recv(PIECESIZE)  # Dự phòng thêm 20 byte cho header
-        if not piece_data:
-            print(f"Failed to download piece {piece_index} from {peer_ip}:{peer_port}")
+        # Nhận dữ liệu mảnh, đọc đủ cả frame vào buffer cấp sẵn
+        buffer = bytearray(piece_size)
+        msg_type, piece_data = proto.request(download_socket, request, buffer)
+        if msg_type != proto.MSG_PIECE or not piece_data:
+            print(f"Failed to download piece {piece_index} from {peer_ip}:{peer_port}: {proto.decode_text(piece_data)}")
             return False
         
-        # Lưu mảnh vào file tạm
-        piece_path = os.path.join(save_path, f"{file_name}.part{piece_index}")
-        with open(piece_path, "wb") as f:
-            f.write(piece_data)
+        write_piece(save_path, file_name, piece_index, piece_data)
         
         print(f"Successfully downloaded piece {piece_index} from {peer_ip}:{peer_port}")
         sleep(0.3)  # Delay to prevent spamming the console
 
-        return True
+        return len(piece_data)
     
     except socket.timeout:
-        print("Timeout: Không nhận được dữ liệu trong 5 giây.")
+        print(f"Timeout downloading piece {piece_index} from {peer_ip}:{peer_port}.")
+        return False
 
     except Exception as e:
         print(f"Error downloading piece {piece_index} from {peer_ip}:{peer_port}: {e}")
         return False
     finally:
-        download_socket.close()
+        if download_socket:
+            download_socket.close()
 
-def download_file(file_name, nodes, magnet_link, total_pieces, save_path="downloads"):
+def piece_holders(nodes, bitfields, piece_index):
+    """
+    Nodes that hold a piece. A node without a bitfield has the whole file.
+    If nobody is known to hold the piece, fall back to every node.
+    """
+    holders = [node for node in nodes if proto.has_piece(bitfields.get(f"{node[0]}:{node[1]}"), piece_index)]
+    return holders or nodes
+
+def download_file(file_name, nodes, magnet_link, total_pieces, save_path="downloads", bitfields=None, on_progress=None,
+                  on_piece=None, window=None, workers=None, engine=None):
     """
     Tải toàn bộ file từ danh sách các nodes được cung cấp.
     Inputs:
@@ -213,7 +605,22 @@ def download_file(file_name, nodes, magnet_link, total_pieces, save_path="downlo
         magnet_link (str): 
         total_pieces (int): 
         save_path (str):
+        bitfields (dict): "ip:port" -> bitfield (bytes) of nodes that only hold part
+            of the file, as returned by FIND_FILE. Each piece is only requested
+            from nodes that hold it.
+        on_progress (callable): Called every PROGRESS_INTERVAL seconds with the
+            sorted list of pieces downloaded so far.
+        on_piece (callable): Called as on_piece(piece_index, peer_ip, peer_port, size)
+            after each piece is received, e.g. to log the transfer.
+        window (int): Requests in flight per peer (default PIPELINE_WINDOW).
+        workers (int): Peers downloaded from in parallel (default DOWNLOAD_WORKERS).
+        engine (async_transfer.TransferEngine): If given, the pieces are downloaded on
+            its event loop instead of a thread pool; this call still blocks until done.
     """
+    if not is_plain_file_name(file_name):
+        print(f"Refusing to download {file_name}: not a plain file name.")
+        return False
+
     # Kiểm tra nếu file đã tồn tại
     file_path = os.path.join(save_path, file_name)
     if os.path.exists(file_path):
@@ -222,71 +629,110 @@ def download_file(file_name, nodes, magnet_link, total_pieces, save_path="downlo
     
 
     os.makedirs(save_path, exist_ok=True)
+    piece_size = decode_magnet_link(magnet_link)["piece_size"]
 
-    # Tải từng mảnh
-    threads = []
-    total_nodes = len(nodes)  # Tổng số nodes
-
-    for piece_index in range(total_pieces):
-        # Tính toán node sử dụng theo công thức (piece_index % total_nodes)
-        node_index = piece_index % total_nodes
-        peer_ip = nodes[node_index][0]
-        peer_port = nodes[node_index][1]
-        
-        # Tạo và khởi động thread cho từng piece
-        thread = threading.Thread(
-            target=download_piece,
-            args=(piece_index, peer_ip, peer_port, file_name, save_path)
-        )
-        threads.append(thread)
-        thread.start()
-
-    # Chờ tất cả các luồng tải xong
-    for thread in threads:
-        thread.join()
-
-    # Kết hợp các mảnh lại thành file hoàn chỉnh
-    file_path = os.path.join(save_path, file_name)
-    with open(file_path, "wb") as output_file:
-        for piece_index in range(total_pieces):
-            piece_path = os.path.join(save_path, f"{file_name}.part{piece_index}")
-
-            # Đọc mảnh và ghi vào file hoàn chỉnh
-            if os.path.exists(piece_path):
-                with open(piece_path, "rb") as piece_file:
-                    output_file.write(piece_file.read())
-                os.remove(piece_path)  # Delete the piece after combining
-
-            #M Piece tải không thành công. Phần này Sync
-            else:
-                print(f"Piece {piece_index} is missing. Retrying download...")
-                success = False
-                for _ in range(3):  # Retry up to 3 times
-                    node_index = piece_index % total_nodes
-                    peer_ip = nodes[node_index][0]
-                    peer_port = nodes[node_index][1]
-                    success = download_piece(piece_index, peer_ip, peer_port, file_name, save_path)
-                    if success:
-                        break
-                if not success:
-                    print(f"Failed to download piece {piece_index} after multiple attempts.")
-                    return False
-
-    #Validate the file via magnet_link
-    pieces_metadata = split_file(file_path)
-    downloaded_magnet_link = generate_magnet_link(file_name, pieces_metadata)
-
-    if downloaded_magnet_link != magnet_link:
-        print("Downloaded file is corrupted. Deleting...")
-        print(f"Expected magnet link: {magnet_link}")
-        print(f"Actual magnet link: {downloaded_magnet_link}")
-        os.remove(file_path)
+    bitfields = bitfields or {}
+    try:
+        partial = PartialFile(save_path, file_name, total_pieces, piece_size)
+    except FileExistsError as e:
+        print(e)
         return False
+    try:
+        def save(piece_index, peer_ip, peer_port, piece_data):
+            partial.write(piece_index, piece_data)
+            if on_piece:
+                on_piece(piece_index, peer_ip, peer_port, len(piece_data))
+
+        # Worker pool cố định (thread, hoặc task trên event loop của engine) tải từ hàng đợi piece;
+        # định kỳ báo các piece đã có
+        scheduler_class = engine.scheduler if engine else DownloadScheduler
+        scheduler = scheduler_class(file_name, nodes, bitfields, total_pieces, piece_size, save, workers, window)
+        print(f"Downloading {total_pieces} pieces from {len(nodes)} nodes with {scheduler.workers} workers...")
+        scheduler.run(on_tick=lambda: on_progress(partial.have()) if on_progress else None)
+
+        #M Piece tải không thành công. Phần này Sync
+        for piece_index in sorted(set(range(total_pieces)) - set(partial.have())):
+            print(f"Piece {piece_index} is missing. Retrying download...")
+            success = False
+            holders = piece_holders(nodes, bitfields, piece_index)
+            for attempt in range(3):  # Retry up to 3 times
+                peer_ip, peer_port = holders[(piece_index + attempt) % len(holders)]
+                success = download_piece(piece_index, peer_ip, peer_port, file_name, save_path, piece_size)
+                if success:
+                    if on_piece:
+                        on_piece(piece_index, peer_ip, peer_port, success)
+                    break
+            if not success:
+                print(f"Failed to download piece {piece_index} after multiple attempts.")
+                return False
+
+        #Validate the file via magnet_link, trước khi đổi tên thành file hoàn chỉnh
+        # So info_hash, không so cả link: link cũ không có &ps= dù piece_size giống nhau
+        partial.trim()
+        pieces_metadata = split_file(partial.path, piece_size)
+        downloaded_magnet_link = generate_magnet_link(file_name, pieces_metadata)
+
+        if decode_magnet_link(downloaded_magnet_link)["info_hash"] != decode_magnet_link(magnet_link)["info_hash"]:
+            print("Downloaded file is corrupted. Deleting...")
+            print(f"Expected magnet link: {magnet_link}")
+            print(f"Actual magnet link: {downloaded_magnet_link}")
+            return False
+
+        partial.commit()
+    finally:
+        if partial.fd is not None:
+            partial.discard()
 
     print(f"Download completed! File saved at: {file_path}")
     return True
     
-def upload_piece(root_folder, upload_socket, file_name, piece_index, piece_size=1024):
+def is_plain_file_name(file_name):
+    # Tên do peer/tracker gửi: chỉ được là tên một file trong thư mục chia sẻ (không '..', không đường dẫn)
+    return bool(file_name) and os.path.basename(file_name) == file_name and file_name not in (".", "..")
+
+def read_piece(root_folder, file_name, piece_index, piece_size=None):
+    """
+    Read one piece to upload, from <file_name>.partial while the file is still
+    being downloaded, otherwise from the complete file.
+
+    Returns:
+        tuple: (piece bytes, None), or (None, error message for the requester).
+    """
+    if piece_index < 0:
+        return None, f"Invalid piece index {piece_index}."
+    if not is_plain_file_name(file_name):
+        return None, f"Invalid file name {file_name}."
+
+    file_path = os.path.join(root_folder, file_name)
+    with partial_lock:
+        partial = partial_files.get(os.path.abspath(file_path))
+    if partial:
+        # File đang tải dở: gửi piece đã tải về (đã báo tracker qua HAVE_PIECES)
+        piece_data = partial.read(piece_index)
+        if piece_data is None:
+            return None, f"Piece {piece_index} of file {file_name} is not downloaded yet."
+
+    elif os.path.isfile(file_path):
+        # Request không kèm piece_size là của node cũ, vốn cắt file theo PIECESIZE
+        piece_size = piece_size or PIECESIZE
+        if not 0 < piece_size <= MAX_PIECE_SIZE:
+            return None, f"Invalid piece size {piece_size}."
+
+        # Calculate the byte range for the piece
+        start_byte = piece_index * piece_size
+
+        with open(file_path, "rb") as file:
+            file.seek(start_byte)
+            piece_data = file.read(piece_size)
+
+    else:
+        return None, f"File {file_name} not found."
+
+    if not piece_data:
+        return None, f"Piece {piece_index} is out of range for file {file_name}."
+    return piece_data, None
+
+def upload_piece(root_folder, upload_socket, file_name, piece_index, piece_size=None):
     """
     Upload a specific piece of a file (in bits) to the client.
     
@@ -295,33 +741,28 @@ def upload_piece(root_folder, upload_socket, file_name, piece_index, piece_size=
         client_socket (socket): The client socket to send the piece to.
         file_name (str): The name of the file.
         piece_index (int): The index of the piece to upload.
-        piece_size (int): The size of each piece in bytes (default is 1024 bytes).
+        piece_size (int): The size of each piece in bytes, as sent by the downloader
+            (from the magnet link). Default: PIECESIZE, what old nodes that send no size expect.
     
     Returns:
         bool: True if the piece was successfully uploaded, False otherwise.
     """
     try:
-        file_path = os.path.join(root_folder, file_name)
-        if not os.path.isfile(file_path):
-            upload_socket.sendall(f"File {file_name} not found.".encode('utf-8'))
-            return False
-
-        # Calculate the byte range for the piece
-        start_byte = piece_index * piece_size
-
-        with open(file_path, "rb") as file:
-            file.seek(start_byte)
-            piece_data = file.read(piece_size)
-
-        if not piece_data:
-            upload_socket.sendall(f"Piece {piece_index} is out of range for file {file_name}.".encode('utf-8'))
+        piece_data, error = read_piece(root_folder, file_name, piece_index, piece_size)
+        if error:
+            proto.send_error(upload_socket, error)
             return False
 
         # Send the piece data to the client
-        upload_socket.sendall(piece_data)
+        proto.send_frame(upload_socket, proto.MSG_PIECE, piece_data)
         print(f"Successfully uploaded piece {piece_index} of file {file_name}.")
         return True
 
     except Exception as e:
         print(f"Error uploading piece {piece_index} of file {file_name}: {e}")
+        # Vẫn trả lời để client đang pipeline không phải chờ hết timeout
+        try:
+            proto.send_error(upload_socket, f"Could not read piece {piece_index} of file {file_name}.")
+        except OSError:
+            pass
         return False
\ No newline at end of file
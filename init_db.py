@@ -1,4 +1,45 @@
 import sqlite3
+import urllib.parse
+
+# Cột có trong schema hiện tại nhưng thiếu ở các file tracker.db cũ
+ADDED_COLUMNS = {
+    "Files": [("magnet_link", "TEXT"), ("info_hash", "TEXT")],
+    "Nodes": [("last_seen", "REAL")],
+    "Transactions": [("bytes", "INTEGER NOT NULL DEFAULT 0"), ("created_at", "INTEGER")],
+}
+
+# Cột của schema cũ không còn dùng (vd: NOT NULL, không có default -> INSERT mới bị lỗi).
+# Bảng có các cột này được dựng lại từ TABLES, vì ALTER TABLE DROP COLUMN cần SQLite >= 3.35
+LEGACY_COLUMNS = {
+    "Nodes": ["files_holding"],
+    "Pieces": ["node_having"],
+}
+
+# Index của schema cũ: file_name từng là khoá duy nhất, nay là info_hash
+LEGACY_INDEXES = ["idx_files_name"]
+
+# AUTOINCREMENT: nid của node đã rời đi không bao giờ được cấp lại, để node mới
+# không thừa hưởng lịch sử Transactions của node cũ
+NODES_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        nid INTEGER PRIMARY KEY AUTOINCREMENT,
+        ip_address TEXT NOT NULL,
+        port INTEGER NOT NULL,
+        last_seen REAL
+    )
+    '''
+
+PIECES_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        pid INTEGER PRIMARY KEY,
+        file_id INTEGER NOT NULL,
+        piece_index INTEGER NOT NULL,
+        FOREIGN KEY (file_id) REFERENCES Files(fid)
+    )
+    '''
+
+# Bảng có thể phải dựng lại khi migrate, xem _rebuild_table()
+TABLES = {"Nodes": NODES_TABLE, "Pieces": PIECES_TABLE}
 
 def initialize_database(db_name="tracker.db"):
     """
@@ -13,13 +54,7 @@ def initialize_database(db_name="tracker.db"):
 
 
     # Create the Nodes table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS Nodes (
-        nid INTEGER PRIMARY KEY,
-        ip_address TEXT NOT NULL,
-        port INTEGER NOT NULL
-    )
-    ''')
+    cursor.execute(NODES_TABLE.format(name="Nodes"))
 
     # Create the Files table
     cursor.execute('''
@@ -27,19 +62,13 @@ def initialize_database(db_name="tracker.db"):
         fid INTEGER PRIMARY KEY,
         file_name TEXT NOT NULL,
         total_piece INTEGER NOT NULL,
-        magnet_link TEXT
+        magnet_link TEXT,
+        info_hash TEXT
     )
     ''')
 
     # Create the Pieces table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS Pieces (
-        pid INTEGER PRIMARY KEY,
-        file_id INTEGER NOT NULL,
-        piece_index INTEGER NOT NULL,
-        FOREIGN KEY (file_id) REFERENCES Files(fid)
-    )
-    ''')
+    cursor.execute(PIECES_TABLE.format(name="Pieces"))
 
     # Create the PiecesNodes table to support the N-M relationship
     cursor.execute('''
@@ -71,6 +100,8 @@ def initialize_database(db_name="tracker.db"):
         upload_node INTEGER NOT NULL,
         file_id INTEGER NOT NULL,
         piece_id INTEGER NOT NULL,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER,
 
         FOREIGN KEY (download_node) REFERENCES Nodes(nid),
         FOREIGN KEY (upload_node) REFERENCES Nodes(nid),
@@ -79,11 +110,160 @@ def initialize_database(db_name="tracker.db"):
     )
     ''')
 
+    migrate_database(cursor)
+    create_indexes(cursor)
+
     # Commit changes and close the connection
     conn.commit()
     conn.close()
     print(f"Database '{db_name}' has been initialized!")
 
+def _columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cursor.fetchall()}
+
+def info_hash_of(magnet_link):
+    """
+    Extract the info_hash from a magnet link built by file_transfer.generate_magnet_link.
+    """
+    query_params = urllib.parse.parse_qs(urllib.parse.urlparse(magnet_link).query)
+    return query_params.get("xt", [""])[0].split(":")[-1]
+
+def migrate_database(cursor):
+    """
+    Bring a tracker.db created by an older version up to the current schema:
+    add missing columns, drop legacy ones, and merge duplicate Nodes/Files rows
+    so the unique indexes of create_indexes() can be built.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor inside the initialization transaction.
+    """
+    for table, columns in ADDED_COLUMNS.items():
+        existing = _columns(cursor, table)
+        for column, column_type in columns:
+            if column not in existing:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+                print(f"Migrated {table}: added column {column}")
+
+    # Trước các cột cũ: dựng lại Nodes cũng bỏ luôn cột cũ của nó
+    _rebuild_nodes_autoincrement(cursor)
+
+    for table, columns in LEGACY_COLUMNS.items():
+        legacy = [column for column in columns if column in _columns(cursor, table)]
+        if legacy:
+            _rebuild_table(cursor, table)
+            print(f"Migrated {table}: dropped legacy columns {', '.join(legacy)}")
+
+    # Gộp các Node trùng (ip, port) về nid nhỏ nhất
+    cursor.execute('''
+    UPDATE OR IGNORE NodesFiles SET node_id = (
+        SELECT MIN(k.nid) FROM Nodes n JOIN Nodes k
+        ON k.ip_address = n.ip_address AND k.port = n.port
+        WHERE n.nid = NodesFiles.node_id
+    )
+    ''')
+    cursor.execute('''
+    DELETE FROM Nodes WHERE nid NOT IN (SELECT MIN(nid) FROM Nodes GROUP BY ip_address, port)
+    ''')
+    if cursor.rowcount > 0:
+        print(f"Migrated Nodes: merged {cursor.rowcount} duplicate rows")
+
+    for index in LEGACY_INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {index}")
+
+    # Điền info_hash cho các File cũ từ magnet link
+    cursor.execute("SELECT fid, magnet_link FROM Files WHERE info_hash IS NULL AND magnet_link IS NOT NULL")
+    backfill = [(info_hash_of(magnet_link), fid) for fid, magnet_link in cursor.fetchall()]
+    cursor.executemany("UPDATE Files SET info_hash = ? WHERE fid = ?", backfill)
+    if backfill:
+        print(f"Migrated Files: filled info_hash of {len(backfill)} rows")
+
+    # Gộp các File trùng info_hash về fid nhỏ nhất (File không có magnet link: gộp theo tên)
+    cursor.execute('''
+    UPDATE OR IGNORE NodesFiles SET file_id = (
+        SELECT MIN(k.fid) FROM Files f JOIN Files k
+        ON COALESCE(k.info_hash, 'name:' || k.file_name) = COALESCE(f.info_hash, 'name:' || f.file_name)
+        WHERE f.fid = NodesFiles.file_id
+    )
+    ''')
+    cursor.execute('''
+    DELETE FROM Files WHERE fid NOT IN (
+        SELECT MIN(fid) FROM Files GROUP BY COALESCE(info_hash, 'name:' || file_name)
+    )
+    ''')
+    if cursor.rowcount > 0:
+        print(f"Migrated Files: merged {cursor.rowcount} duplicate rows")
+
+    # Gộp các Piece trùng (file_id, piece_index)
+    cursor.execute('''
+    UPDATE OR IGNORE PiecesNodes SET piece_id = (
+        SELECT MIN(k.pid) FROM Pieces p JOIN Pieces k
+        ON k.file_id = p.file_id AND k.piece_index = p.piece_index
+        WHERE p.pid = PiecesNodes.piece_id
+    )
+    ''')
+    cursor.execute('''
+    DELETE FROM Pieces WHERE pid NOT IN (SELECT MIN(pid) FROM Pieces GROUP BY file_id, piece_index)
+    ''')
+    cursor.execute("DELETE FROM PiecesNodes WHERE piece_id NOT IN (SELECT pid FROM Pieces)")
+
+    # Dòng NodesFiles còn trỏ tới Node/File vừa bị gộp (do UPDATE OR IGNORE bỏ qua)
+    cursor.execute('''
+    DELETE FROM NodesFiles
+    WHERE node_id NOT IN (SELECT nid FROM Nodes) OR file_id NOT IN (SELECT fid FROM Files)
+    ''')
+
+def _rebuild_nodes_autoincrement(cursor):
+    """
+    Recreate a Nodes table of an older tracker.db (nid without AUTOINCREMENT,
+    SQLite reuses the nid of a deleted node) and start its sequence after every
+    nid still referenced by Transactions. The indexes are rebuilt by create_indexes().
+    """
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'Nodes'")
+    if "AUTOINCREMENT" in cursor.fetchone()[0].upper():
+        return
+
+    _rebuild_table(cursor, "Nodes")
+    cursor.execute('''
+    SELECT MAX(COALESCE((SELECT MAX(nid) FROM Nodes), 0),
+               COALESCE((SELECT MAX(upload_node) FROM Transactions), 0),
+               COALESCE((SELECT MAX(download_node) FROM Transactions), 0))
+    ''')
+    (last_nid,) = cursor.fetchone()
+    cursor.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'Nodes'", (last_nid,))
+    if cursor.rowcount == 0:
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('Nodes', ?)", (last_nid,))
+    print("Migrated Nodes: nid is now AUTOINCREMENT")
+
+def _rebuild_table(cursor, table):
+    """
+    Recreate a table from its current definition in TABLES and copy its rows,
+    dropping the columns the definition no longer has. The indexes are rebuilt
+    by create_indexes().
+    """
+    cursor.execute(TABLES[table].format(name=f"{table}_new"))
+    columns = ", ".join(sorted(_columns(cursor, f"{table}_new") & _columns(cursor, table)))
+    cursor.execute(f"INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+def create_indexes(cursor):
+    """
+    Unique indexes backing the ON CONFLICT upserts in db_manager, so registration
+    is an index probe instead of a table scan.
+    """
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_nodes_ip_port ON Nodes (ip_address, port)")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_files_info_hash ON Files (info_hash)")
+    # Tên file không còn duy nhất, chỉ dùng để tra cứu
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_file_name ON Files (file_name)")
+    # NodesFiles có PRIMARY KEY (file_id, node_id); thêm index theo node_id cho REMOVE_NODE (db_manager.apply_batch)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_nodesfiles_node ON NodesFiles (node_id)")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_pieces_file_index ON Pieces (file_id, piece_index)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_piecesnodes_node ON PiecesNodes (node_id)")
+    # Cho các truy vấn thống kê của db_manager.swarm_analytics (gom nhóm theo file / node upload)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_file ON Transactions (file_id, download_node)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_upload ON Transactions (upload_node)")
+
 def delete_all_data(db_name="tracker.db"):
     """
     Deletes all data from all tables in the database.
@@ -0,0 +1,336 @@
+import asyncio
+import base64
+import json
+import re
+import socket
+import struct
+
+'''
+Wire format dùng chung cho Tracker <-> Node và Node <-> Node.
+
+Mỗi message là một frame có header cố định 6 byte:
+
+    +---------+----------+----------------+-----------------+
+    | version | msg_type | payload length |     payload     |
+    | 1 byte  |  1 byte  | 4 bytes (BE)   | <length> bytes  |
+    +---------+----------+----------------+-----------------+
+
+Bên nhận đọc đúng 6 byte header rồi đọc đúng <length> byte payload bằng
+recv_into, nên việc TCP cắt/gộp segment không còn làm hỏng message.
+'''
+
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BBI")
+MAX_PAYLOAD = 64 * 1024 * 1024      # Chặn frame lỗi/độc hại đòi cấp phát quá lớn
+
+# Message types
+MSG_COMMAND = 1     # Lệnh dạng text, vd: "FIND_FILE meme137.jpg"
+MSG_TEXT = 2        # Trả lời dạng text
+MSG_JSON = 3        # Trả lời dạng JSON
+MSG_PIECE = 4       # Dữ liệu thô của một piece
+MSG_ERROR = 5       # Thông báo lỗi dạng text
+MSG_COMPACT = 6     # Trả lời FIND_FILE(S) với danh sách peer dạng binary, xem pack_swarm()
+MSG_RETRY_AFTER = 7 # Tracker quá tải: payload là số giây (text) nên chờ trước khi gửi lại
+
+COMPACT_META = struct.Struct("!I")  # Độ dài phần JSON metadata trong frame MSG_COMPACT
+PEER4 = struct.Struct("!4sH")       # IPv4 + port = 6 byte
+PEER6 = struct.Struct("!16sH")      # IPv6 + port = 18 byte
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends a frame we cannot understand."""
+
+
+class RetryAfter(Exception):
+    """Raised by request() when the tracker is overloaded and asks to come back later."""
+
+    def __init__(self, seconds):
+        super().__init__(f"Tracker busy, retry after {seconds}s")
+        self.seconds = seconds
+
+
+def recv_exact_into(sock, view):
+    """
+    Fill the whole memoryview from the socket.
+
+    Args:
+        sock (socket): Connected socket.
+        view (memoryview): Writable buffer to fill.
+
+    Returns:
+        int: Number of bytes read. Less than len(view) only if the peer closed
+        the connection before sending anything.
+    """
+    total = len(view)
+    read = 0
+    while read < total:
+        n = sock.recv_into(view[read:], total - read)
+        if n == 0:
+            if read == 0:
+                return 0
+            raise ConnectionError(f"Connection closed after {read}/{total} bytes")
+        read += n
+    return read
+
+
+def recv_frame(sock, buffer=None):
+    """
+    Read one frame from the socket.
+
+    Args:
+        sock (socket): Connected socket.
+        buffer (bytearray): Optional preallocated buffer. If the payload fits, it
+            is read straight into it and a memoryview over it is returned, which
+            is only valid until the next call with the same buffer.
+
+    Returns:
+        tuple: (msg_type, payload), or (None, None) if the peer closed the
+        connection cleanly between two frames.
+    """
+    header = bytearray(HEADER.size)
+    if recv_exact_into(sock, memoryview(header)) == 0:
+        return None, None
+
+    version, msg_type, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Frame too large: {length} bytes")
+
+    if buffer is not None and length <= len(buffer):
+        payload = memoryview(buffer)[:length]
+    else:
+        payload = memoryview(bytearray(length))
+
+    if length and recv_exact_into(sock, payload) == 0:
+        raise ConnectionError("Connection closed before payload")
+    return msg_type, payload
+
+
+async def read_frame(reader):
+    """
+    recv_frame for an asyncio.StreamReader (see async_transfer.py).
+
+    Returns:
+        tuple: (msg_type, payload bytes), or (None, None) if the peer closed the
+        connection cleanly between two frames.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None, None
+        raise ConnectionError(f"Connection closed after {len(e.partial)}/{HEADER.size} bytes")
+
+    version, msg_type, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Frame too large: {length} bytes")
+
+    try:
+        payload = await reader.readexactly(length) if length else b""
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed before payload")
+    return msg_type, payload
+
+
+def encode_frame(msg_type, payload=b""):
+    """
+    Header + payload of one frame as bytes, e.g. to cache a reply and send it again.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, len(payload)) + bytes(payload)
+
+def send_frame(sock, msg_type, payload=b""):
+    """
+    Send one frame. The header and payload go out in a single sendall so that a
+    small frame is never split into two segments by Nagle.
+    """
+    sock.sendall(encode_frame(msg_type, payload))
+
+
+'''
+Helpers
+'''
+def send_command(sock, command):
+    send_frame(sock, MSG_COMMAND, command)
+
+def send_text(sock, text):
+    send_frame(sock, MSG_TEXT, text)
+
+def send_error(sock, text):
+    send_frame(sock, MSG_ERROR, text)
+
+def send_json(sock, obj):
+    send_frame(sock, MSG_JSON, json.dumps(obj))
+
+def send_retry_after(sock, seconds):
+    send_frame(sock, MSG_RETRY_AFTER, f"{seconds:.3f}")
+
+def decode_text(payload):
+    return bytes(payload).decode('utf-8')
+
+OPTION_PATTERN = re.compile(r"^([a-z_]+)=(\w+)$")
+
+def split_options(tokens):
+    """
+    Split command arguments into positional arguments and key=value options,
+    e.g. ["meme137.jpg", "numwant=20"] -> (["meme137.jpg"], {"numwant": "20"}).
+    """
+    args, options = [], {}
+    for token in tokens:
+        match = OPTION_PATTERN.match(token)
+        if match:
+            options[match.group(1)] = match.group(2)
+        else:
+            args.append(token)
+    return args, options
+
+def request(sock, command, buffer=None):
+    """
+    Send a command and wait for its reply.
+
+    Returns:
+        tuple: (msg_type, payload) of the reply.
+    Raises:
+        RetryAfter: If the tracker did not run the command because it is overloaded.
+    """
+    send_command(sock, command)
+    msg_type, payload = recv_frame(sock, buffer)
+    if msg_type is None:
+        raise ConnectionError("Connection closed while waiting for reply")
+    if msg_type == MSG_RETRY_AFTER:
+        raise RetryAfter(float(decode_text(payload)))
+    return msg_type, payload
+
+
+'''
+Compact peer lists
+
+Thay vì JSON [["192.168.56.104", 1100], ...] (~25 byte/peer và phải parse từng
+chuỗi), peer được đóng gói 6 byte (IPv4) hoặc 18 byte (IPv6) vào một blob
+chung. Frame MSG_COMPACT = 4 byte độ dài metadata + metadata JSON + blob.
+Mỗi swarm trong metadata giữ "peers4"/"peers6" = [offset, count] trỏ vào blob.
+'''
+def pack_swarm(swarm_info, blob):
+    """
+    Move the peers of one FIND_FILE result into the shared blob.
+
+    Args:
+        swarm_info (dict): {"nodes": [[ip, port], ...], ...} as returned by the swarm index.
+        blob (bytearray): Shared peer blob, extended in place.
+
+    Returns:
+        dict: Copy of swarm_info where "nodes" only keeps peers whose address is not
+        an IP literal, plus "peers4" and "peers6" entries.
+    """
+    peers4, peers6, others = [], [], []
+    for ip, port in swarm_info["nodes"]:
+        try:
+            peers4.append(PEER4.pack(socket.inet_pton(socket.AF_INET, ip), port))
+            continue
+        except OSError:
+            pass
+        try:
+            peers6.append(PEER6.pack(socket.inet_pton(socket.AF_INET6, ip), port))
+        except OSError:
+            others.append([ip, port])
+
+    meta = dict(swarm_info, nodes=others)
+    meta["peers4"] = [len(blob), len(peers4)]
+    blob += b"".join(peers4)
+    meta["peers6"] = [len(blob), len(peers6)]
+    blob += b"".join(peers6)
+    return meta
+
+def unpack_swarm(meta, blob):
+    """
+    Inverse of pack_swarm: rebuild the "nodes" list of [ip, port].
+    """
+    nodes = list(meta.get("nodes", []))
+    offset, count = meta["peers4"]
+    for address, port in PEER4.iter_unpack(blob[offset:offset + count * PEER4.size]):
+        nodes.append([socket.inet_ntop(socket.AF_INET, address), port])
+    offset, count = meta["peers6"]
+    for address, port in PEER6.iter_unpack(blob[offset:offset + count * PEER6.size]):
+        nodes.append([socket.inet_ntop(socket.AF_INET6, address), port])
+
+    swarm_info = {key: value for key, value in meta.items() if key not in ("peers4", "peers6")}
+    swarm_info["nodes"] = nodes
+    return swarm_info
+
+def compact_payload(meta, blob):
+    meta_bytes = json.dumps(meta).encode('utf-8')
+    return COMPACT_META.pack(len(meta_bytes)) + meta_bytes + bytes(blob)
+
+def send_compact(sock, meta, blob):
+    send_frame(sock, MSG_COMPACT, compact_payload(meta, blob))
+
+def find_reply_frame(swarm_info, compact=False):
+    """
+    Encoded reply to FIND_FILE with one swarm, as JSON or MSG_COMPACT.
+    """
+    if compact:
+        blob = bytearray()
+        return encode_frame(MSG_COMPACT, compact_payload(pack_swarm(swarm_info, blob), blob))
+    return encode_frame(MSG_JSON, json.dumps(swarm_info))
+
+def send_find_reply(sock, swarm_info, compact=False):
+    sock.sendall(find_reply_frame(swarm_info, compact))
+
+def send_find_files_reply(sock, swarms, compact=False):
+    """
+    Reply to FIND_FILES with {key: swarm or None}, as JSON or MSG_COMPACT.
+    """
+    if compact:
+        blob = bytearray()
+        meta = {key: pack_swarm(info, blob) if info else None for key, info in swarms.items()}
+        send_compact(sock, {"files": meta}, blob)
+    else:
+        send_json(sock, {"files": swarms})
+
+def decode_compact(payload):
+    """
+    Returns:
+        tuple: (meta, blob) of a MSG_COMPACT payload.
+    """
+    payload = memoryview(payload)
+    (meta_length,) = COMPACT_META.unpack(payload[:COMPACT_META.size])
+    meta_end = COMPACT_META.size + meta_length
+    meta = json.loads(bytes(payload[COMPACT_META.size:meta_end]).decode('utf-8'))
+    return meta, bytes(payload[meta_end:])
+
+
+'''
+Piece bitfields
+
+Bit i (tính từ bit cao nhất của byte đầu tiên, giống BitTorrent) = 1 nếu node
+đang giữ piece i. Trên wire bitfield được gửi dạng base64.
+'''
+def make_bitfield(indices, total_piece):
+    bitfield = bytearray((total_piece + 7) // 8)
+    for index in indices:
+        bitfield[index >> 3] |= 0x80 >> (index & 7)
+    return bytes(bitfield)
+
+def has_piece(bitfield, index):
+    """
+    A missing bitfield (None) means the node has the whole file.
+    """
+    if bitfield is None:
+        return True
+    byte = index >> 3
+    return byte < len(bitfield) and bool(bitfield[byte] & (0x80 >> (index & 7)))
+
+def bitfield_indices(bitfield):
+    return [byte * 8 + bit
+            for byte, value in enumerate(bitfield) if value
+            for bit in range(8) if value & (0x80 >> bit)]
+
+def encode_bitfield(bitfield):
+    return base64.b64encode(bitfield).decode('ascii')
+
+def decode_bitfield(text):
+    return base64.b64decode(text)
@@ -0,0 +1,300 @@
+import json
+import re
+import socket
+import threading
+import zlib
+from threading import Thread
+
+import db_manager as db
+import protocol as proto
+import swarm
+from init_db import info_hash_of
+
+'''
+Chế độ nhiều process của tracker (Tracker.py --processes N).
+
+N process cùng listen trên một port công khai (SO_REUSEPORT, kernel chia
+connection cho các process). Mỗi process là một shard, chỉ giữ các swarm có
+shard_of(info_hash) == SHARD_INDEX, cùng tracker_shard<i>.db riêng.
+
+Mỗi shard còn listen nội bộ trên SHARD_HOST:SHARD_BASE_PORT + i. Khi một lệnh
+tới nhầm shard, handle() chuyển nguyên lệnh (cùng wire format) sang shard sở
+hữu swarm và trả lại reply của nó cho node:
+
+    REGISTER_NODE, ANNOUNCE, DISCONNECT*  -> gửi cho mọi shard (node có thể có file ở mọi shard)
+    REGISTER_FILE, HAVE_PIECES <hash>      -> shard sở hữu info_hash
+    REGISTER_FILES, REPORT_TRANSFERS       -> chia batch theo shard
+    FIND_FILE <hash | magnet>              -> shard sở hữu info_hash
+    FIND_FILE <tên>, FIND_FILES, ANALYTICS -> hỏi mọi shard, gộp kết quả
+'''
+
+SHARD_COUNT = 1
+SHARD_INDEX = 0
+SHARD_HOST = "127.0.0.1"
+SHARD_BASE_PORT = None      # Shard i nhận lệnh nội bộ trên SHARD_BASE_PORT + i
+
+INFO_HASH_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+BROADCAST_COMMANDS = {"REGISTER_NODE", "ANNOUNCE", "DISCONNECT", "DISCONNECT_NODE"}
+
+_local = threading.local()  # Mỗi worker thread giữ một connection tới mỗi shard khác
+
+
+def configure(index, count, base_port):
+    global SHARD_INDEX, SHARD_COUNT, SHARD_BASE_PORT
+    SHARD_INDEX = index
+    SHARD_COUNT = count
+    SHARD_BASE_PORT = base_port
+
+def enabled():
+    return SHARD_COUNT > 1
+
+def shard_of(info_hash):
+    return zlib.crc32(info_hash.encode('utf-8')) % SHARD_COUNT
+
+def key_shard(key):
+    """
+    Shard owning the swarm of a FIND/HAVE_PIECES key, or None if the key is a
+    file name (names are not sharded, every shard may hold one).
+    """
+    if key.startswith("magnet:"):
+        return shard_of(info_hash_of(key))
+    if INFO_HASH_PATTERN.match(key):
+        return shard_of(key)
+    return None
+
+def _others():
+    return [index for index in range(SHARD_COUNT) if index != SHARD_INDEX]
+
+
+'''
+Forwarding
+'''
+def _connection(index):
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    if index not in conns:
+        conns[index] = socket.create_connection((SHARD_HOST, SHARD_BASE_PORT + index), timeout=10)
+    return conns[index]
+
+def forward(index, command):
+    """
+    Send a command to shard `index` and wait for its reply. The pooled
+    connection is reopened once if the other shard closed it.
+
+    Returns:
+        tuple: (msg_type, payload bytes).
+    """
+    for attempt in range(2):
+        try:
+            msg_type, payload = proto.request(_connection(index), command)
+            return msg_type, bytes(payload)
+        except OSError:
+            conn = _local.conns.pop(index, None)
+            if conn:
+                conn.close()
+            if attempt:
+                raise
+
+def broadcast(command):
+    """
+    Send a command to every other shard, ignoring the replies.
+    """
+    for index in _others():
+        forward(index, command)
+
+def relay(conn, index, command):
+    msg_type, payload = forward(index, command)
+    proto.send_frame(conn, msg_type, payload)
+
+def _best(*results):
+    # Tên file trùng ở nhiều shard: chọn swarm đông peer nhất, giống swarm._resolve
+    results = [result for result in results if result]
+    return max(results, key=lambda result: len(result["nodes"])) if results else None
+
+def _find_remote(keys, numwant):
+    """
+    Ask every other shard for `keys` (JSON form) and return their answers as
+    a list of {key: swarm or None}.
+    """
+    command = "FIND_FILES " + " ".join(keys) + (f" numwant={numwant}" if numwant else "")
+    answers = []
+    for index in _others():
+        msg_type, payload = forward(index, command)
+        if msg_type == proto.MSG_JSON:
+            answers.append(json.loads(payload.decode('utf-8'))["files"])
+    return answers
+
+
+def handle(conn, data):
+    """
+    Route a command received on the public port.
+
+    Returns:
+        bool: True if the command has been answered here; False if the local
+        shard should run it as usual.
+    Raises:
+        ValueError, IndexError: Malformed command, answered by the caller.
+    """
+    line, _, body = data.partition("\n")
+    command, *args = line.split()
+
+    if command in BROADCAST_COMMANDS:
+        broadcast(data)
+        return False
+
+    if command == "REGISTER_FILE":
+        owner = shard_of(info_hash_of(args[4]))
+    elif command == "HAVE_PIECES":
+        owner = key_shard(args[2])
+    elif command == "REGISTER_FILES":
+        register_files(conn, args, body)
+        return True
+    elif command == "REPORT_TRANSFERS":
+        report_transfers(conn, args, body)
+        return True
+    elif command == "ANALYTICS":
+        analytics_everywhere(conn, data, proto.split_options(args)[1])
+        return True
+    elif command in ("FIND_FILE", "FIND_FILES"):
+        keys, options = proto.split_options(args)
+        if command == "FIND_FILE" and len(keys) != 1:
+            raise ValueError(f"FIND_FILE takes one key, got {len(keys)}")
+        if command == "FIND_FILE" and key_shard(keys[0]) is not None:
+            owner = key_shard(keys[0])
+        else:
+            find_everywhere(conn, command, keys, options)
+            return True
+    else:
+        return False
+
+    if owner is None or owner == SHARD_INDEX:
+        return False
+    relay(conn, owner, data)
+    return True
+
+def register_files(conn, args, body):
+    """
+    Split a REGISTER_FILES batch by owning shard and sum up the replies.
+    """
+    client_ip, client_port = args
+    entries = json.loads(body)
+    swarm.check_file_list(entries)     # Cả batch hợp lệ rồi mới chia: không đăng ký dở một nửa
+    groups = {}
+    for entry in entries:
+        groups.setdefault(shard_of(info_hash_of(entry[2])), []).append(entry)
+
+    registered = 0
+    message = "Node not found."
+    for index, file_list in groups.items():
+        if index == SHARD_INDEX:
+            result = swarm.add_files(client_ip, client_port, file_list)
+        else:
+            _, payload = forward(index, f"REGISTER_FILES {client_ip} {client_port}\n" + json.dumps(file_list))
+            result = json.loads(payload.decode('utf-8'))
+        registered += result["registered"]
+        if result["registered"] == 0:
+            message = result["message"]
+
+    if registered:
+        message = f"{registered} files registered and added to the node!"
+    proto.send_json(conn, {"registered": registered, "message": message})
+
+def report_transfers(conn, args, body):
+    """
+    Split a REPORT_TRANSFERS batch by the shard owning each file.
+    """
+    client_ip, client_port = args
+    transfers = json.loads(body)
+    swarm.check_transfers(transfers)
+    groups = {}
+    for transfer in transfers:
+        groups.setdefault(shard_of(transfer[2]), []).append(transfer)
+
+    for index, transfers in groups.items():
+        if index == SHARD_INDEX:
+            swarm.record_transfers(client_ip, client_port, transfers)
+        else:
+            forward(index, f"REPORT_TRANSFERS {client_ip} {client_port}\n" + json.dumps(transfers))
+    proto.send_text(conn, "OK")
+
+def analytics_everywhere(conn, command, options):
+    """
+    ANALYTICS over every shard's DB: sum the totals and the uploaders (a node
+    uploads in every shard), concatenate the per-file lists (each file lives in one shard).
+    Uploaders are summed over each shard's own top `limit`, so the ranking is approximate.
+    """
+    limit = int(options.get("limit", 10))
+    results = [db.swarm_analytics(limit)]
+    for index in _others():
+        _, payload = forward(index, command)
+        results.append(json.loads(payload.decode('utf-8')))
+
+    totals = {"transfers": 0, "bytes": 0}
+    uploaders = {}
+    merged = {"totals": totals, "top_uploaders": [], "swarms": [], "completions": []}
+    for result in results:
+        for key in totals:
+            totals[key] += result["totals"][key]
+        for row in result["top_uploaders"]:
+            total = uploaders.setdefault(row["node"], {"node": row["node"], "bytes": 0, "pieces": 0})
+            total["bytes"] += row["bytes"]
+            total["pieces"] += row["pieces"]
+        merged["swarms"] += result["swarms"]
+        merged["completions"] += result["completions"]
+
+    merged["top_uploaders"] = sorted(uploaders.values(), key=lambda row: row["bytes"], reverse=True)[:limit]
+    merged["swarms"] = sorted(merged["swarms"], key=lambda row: row["bytes"], reverse=True)[:limit]
+    merged["completions"] = sorted(merged["completions"], key=lambda row: row["completed"], reverse=True)[:limit]
+    proto.send_json(conn, merged)
+
+def find_everywhere(conn, command, keys, options):
+    """
+    FIND_FILE by name or FIND_FILES: look up the local index and every other
+    shard, keep the best swarm of each key, then reply in the requested form.
+    """
+    numwant = int(options.get("numwant", 0))
+    merged = swarm.lookup_many(keys, numwant)
+    for answer in _find_remote(keys, numwant):
+        for key in keys:
+            merged[key] = _best(merged[key], answer.get(key))
+
+    compact = options.get("compact") == "1"
+    if command == "FIND_FILES":
+        proto.send_find_files_reply(conn, merged, compact)
+    elif merged[keys[0]]:
+        proto.send_find_reply(conn, merged[keys[0]], compact)
+    else:
+        proto.send_error(conn, f"File {keys[0]} not found.")
+
+
+'''
+Internal listener
+'''
+def _accept_internal(server_socket, handler):
+    while True:
+        try:
+            conn, addr = server_socket.accept()
+        except OSError:
+            break   # Socket đã bị đóng
+        # Thread riêng, không dùng worker pool: worker của shard khác có thể đang
+        # chờ chính reply này, dùng chung pool có thể deadlock khi pool đầy
+        Thread(target=handler, args=(conn, addr), daemon=True).start()
+
+def start_internal_server(handler):
+    """
+    Listen for commands forwarded by the other shards.
+
+    Args:
+        handler (callable): handler(conn, addr) running the request loop locally.
+
+    Returns:
+        socket: The listening socket.
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((SHARD_HOST, SHARD_BASE_PORT + SHARD_INDEX))
+    server_socket.listen(socket.SOMAXCONN)
+    Thread(target=_accept_internal, args=(server_socket, handler), daemon=True, name="shard-internal").start()
+    print(f"Shard {SHARD_INDEX}/{SHARD_COUNT} accepting forwarded commands on {SHARD_HOST}:{SHARD_BASE_PORT + SHARD_INDEX}")
+    return server_socket
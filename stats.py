@@ -0,0 +1,148 @@
+import json
+import socket
+import time
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+'''
+Thống kê runtime của tracker: số lệnh, histogram latency theo từng lệnh, thời
+gian SQLite theo từng hàm của db_manager, và các gauge (connection đang mở,
+kích thước swarm) do Tracker.py đăng ký.
+
+Histogram dùng các bucket cố định (ms) nên record() chỉ là vài phép cộng dưới
+một lock; p50/p99 được ước lượng bằng cận trên của bucket chứa percentile đó.
+
+Xem bằng lệnh STATS trên CLI của tracker, hoặc đọc JSON qua socket local:
+    nc 127.0.0.1 <stats_port>
+'''
+
+LATENCY_BUCKETS_MS = [0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+groups = {}         # "commands" / "sqlite" -> {name: {"count", "total", "max", "buckets": [..]}}
+gauges = {}         # name -> hàm không tham số trả về giá trị hiện tại
+stats_lock = Lock()
+started_at = time.time()
+
+
+def record(name, seconds, group="commands"):
+    """
+    Add one sample of `seconds` to the histogram of `name`.
+    """
+    ms = seconds * 1000
+    index = 0
+    while index < len(LATENCY_BUCKETS_MS) and ms > LATENCY_BUCKETS_MS[index]:
+        index += 1
+
+    with stats_lock:
+        entry = groups.setdefault(group, {}).get(name)
+        if entry is None:
+            entry = {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+            groups[group][name] = entry
+        entry["count"] += 1
+        entry["total"] += ms
+        entry["max"] = max(entry["max"], ms)
+        entry["buckets"][index] += 1
+
+@contextmanager
+def timed(name, group="sqlite"):
+    """
+    Time a block and record it, e.g. `with stats.timed("apply_batch"):`.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started, group)
+
+def register_gauge(name, func):
+    gauges[name] = func
+
+def percentile(entry, q):
+    """
+    Upper bound (ms) of the bucket holding the q-th quantile, never above the max seen.
+    """
+    rank = q * entry["count"]
+    seen = 0
+    for index, count in enumerate(entry["buckets"]):
+        seen += count
+        if seen >= rank and count:
+            if index < len(LATENCY_BUCKETS_MS):
+                return min(LATENCY_BUCKETS_MS[index], round(entry["max"], 3))
+            return round(entry["max"], 3)
+    return 0.0
+
+def _summary(entry):
+    return {
+        "count": entry["count"],
+        "mean_ms": round(entry["total"] / entry["count"], 3) if entry["count"] else 0.0,
+        "p50_ms": percentile(entry, 0.5),
+        "p99_ms": percentile(entry, 0.99),
+        "max_ms": round(entry["max"], 3),
+        "histogram": dict(zip([f"<={bound}" for bound in LATENCY_BUCKETS_MS] + ["inf"], entry["buckets"])),
+    }
+
+def snapshot():
+    """
+    Returns:
+        dict: {"uptime", "commands": {name: summary}, "sqlite": {name: summary}, <gauges>}.
+    """
+    with stats_lock:
+        result = {"uptime": round(time.time() - started_at, 1)}
+        for group in ("commands", "sqlite"):
+            result[group] = {name: _summary(entry) for name, entry in sorted(groups.get(group, {}).items())}
+
+    for name, func in gauges.items():
+        try:
+            result[name] = func()
+        except Exception as e:
+            result[name] = f"error: {e}"
+    return result
+
+def format_report(data):
+    """
+    Human-readable version of snapshot() for the tracker CLI.
+    """
+    lines = [f"Uptime: {data['uptime']}s"]
+    for group in ("commands", "sqlite"):
+        lines.append(f"{group}:")
+        lines.append(f"  {'name':<16}{'count':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for name, summary in data[group].items():
+            lines.append(f"  {name:<16}{summary['count']:>10}{summary['mean_ms']:>10}"
+                         f"{summary['p50_ms']:>10}{summary['p99_ms']:>10}{summary['max_ms']:>10}")
+    for name, value in data.items():
+        if name not in ("uptime", "commands", "sqlite"):
+            lines.append(f"{name}: {value}")
+    return "\n".join(lines)
+
+
+'''
+Local dump socket
+'''
+def _serve_dump(server_socket):
+    while True:
+        try:
+            conn, _ = server_socket.accept()
+        except OSError:
+            break   # Socket đã bị đóng
+        try:
+            conn.sendall(json.dumps(snapshot()).encode('utf-8') + b"\n")
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+def start_dump_server(port, host="127.0.0.1"):
+    """
+    Serve snapshot() as one line of JSON to every connection on host:port.
+    Only binds to localhost by default: the stats are for the operator, not for nodes.
+
+    Returns:
+        socket: The listening socket (close it to stop the server).
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(5)
+    Thread(target=_serve_dump, args=(server_socket,), daemon=True, name="stats-dump").start()
+    print(f"Stats available on {host}:{port}")
+    return server_socket
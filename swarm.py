@@ -0,0 +1,553 @@
+import heapq
+import queue
+import random
+import time
+from threading import RLock, Thread, Event
+
+import db_manager as db
+from init_db import info_hash_of
+import protocol as proto
+
+'''
+In-memory swarm index của tracker.
+
+FIND_FILE được trả lời hoàn toàn từ các dict dưới đây, không đụng tới SQLite.
+Swarm được định danh bằng info_hash trong magnet link (hai file trùng tên nhưng
+khác nội dung là hai swarm khác nhau); tên file chỉ là index phụ.
+Mọi thay đổi (node mới, file mới, node rời mạng) được đẩy vào một queue và
+một thread nền ghi xuống tracker.db theo từng batch (write-behind).
+
+Node đang tải dở một file báo các piece nó đã có bằng HAVE_PIECES (bitfield);
+node đã đăng ký cả file (REGISTER_FILE) được coi là có mọi piece.
+
+Node gửi ANNOUNCE định kỳ; node nào im lặng quá PEER_TTL giây bị coi là đã chết
+và bị xoá khỏi index bởi thread sweeper. Mỗi node có đúng một deadline trong
+heap; announce chỉ cập nhật last_seen, deadline được dời lại khi tới hạn.
+
+Reply FIND_FILE đã encode được cache trong reply_cache (xem find_reply) và bị
+xoá mỗi khi swarm của file thay đổi: thêm/bớt peer, HAVE_PIECES, node hết hạn
+hoặc được xác nhận lại sau khi nạp từ DB.
+
+Ở chế độ --persistent, tracker nạp lại swarm từ tracker.db khi khởi động
+(load_from_db). Các node nạp lại bị đánh dấu "unverified" và không được trả về
+cho FIND_FILE cho tới khi chúng liên lạc lại (ANNOUNCE, REGISTER_*), node nào
+im lặng quá PEER_TTL thì hết hạn như bình thường.
+'''
+
+#Global
+files = {}          # info_hash -> {"info_hash", "file_name", "magnet_link", "total_piece", "peers": set((ip, port)),
+                    #               "bitfields": {(ip, port): bytes} chỉ cho peer chưa có đủ file}
+by_name = {}        # file_name -> set(info_hash)
+nodes = {}          # (ip, port) -> set(info_hash)
+last_seen = {}      # (ip, port) -> time.monotonic() của lần announce gần nhất
+expiry_heap = []    # (deadline, (ip, port)), xem expire_stale()
+scheduled = {}      # (ip, port) -> deadline đang có hiệu lực trong expiry_heap
+unverified = set()  # (ip, port) nạp lại từ DB, chưa announce kể từ khi tracker khởi động
+index_lock = RLock()
+
+reply_cache = {}    # info_hash -> {(numwant, compact): [frame bytes, ...]}
+cache_hits = 0
+cache_misses = 0
+
+NUMWANT = 50            # Số peer trả về mặc định cho mỗi FIND_FILE
+MAX_NUMWANT = 200       # Client xin nhiều hơn cũng chỉ nhận tối đa chừng này
+PEER_TTL = 90           # Giây không announce thì node bị coi là đã chết
+SWEEP_INTERVAL = 5      # Giây giữa 2 lần quét node hết hạn
+
+CACHE_VARIANTS = 4      # Số mẫu peer (ngẫu nhiên) giữ cho mỗi (file, numwant, compact)
+CACHE_MAX_FILES = 10000 # Số file tối đa có reply trong cache, bỏ file cũ nhất khi đầy
+
+WRITE_INTERVAL = 0.5    # Giây giữa 2 lần ghi batch xuống DB
+MAX_BATCH = 1000        # Số thao tác tối đa trong một transaction
+
+pending_writes = queue.Queue()
+writer_stop = Event()
+writer_thread = None
+sweeper_thread = None
+
+
+def _resolve(key):
+    """
+    Find the entry of a file by info_hash, magnet link or file name.
+    Gọi khi đang giữ index_lock.
+    """
+    if key.startswith("magnet:"):
+        key = info_hash_of(key)
+    entry = files.get(key)
+    if entry is None and key in by_name:
+        # Nhiều file trùng tên: chọn swarm đông peer nhất
+        entry = max((files[info_hash] for info_hash in by_name[key]), key=lambda e: len(e["peers"]))
+    return entry
+
+def _peer(ip, port):
+    return (ip, int(port))
+
+def _invalidate(info_hash):
+    # Gọi khi đang giữ index_lock, mỗi khi peer/bitfield của swarm thay đổi
+    reply_cache.pop(info_hash, None)
+
+def _touch(peer, now=None):
+    # Gọi khi đang giữ index_lock
+    now = time.monotonic() if now is None else now
+    last_seen[peer] = now
+    if peer in unverified:
+        # Node vừa liên lạc -> chắc chắn còn sống, từ giờ được trả về cho FIND_FILE
+        unverified.discard(peer)
+        for info_hash in nodes.get(peer, ()):
+            _invalidate(info_hash)
+    if peer not in scheduled:
+        scheduled[peer] = now + PEER_TTL
+        heapq.heappush(expiry_heap, (scheduled[peer], peer))
+
+def _is_alive(peer, now):
+    return now - last_seen.get(peer, now) < PEER_TTL
+
+
+'''
+Index updates
+'''
+def add_node(ip, port):
+    peer = _peer(ip, port)
+    with index_lock:
+        _touch(peer)
+        if peer in nodes:
+            print(f"Node with IP {ip} and port {port} already exists.")
+            return
+        nodes[peer] = set()
+    pending_writes.put(("REGISTER_NODE", peer))
+
+def announce(ip, port):
+    """
+    Heartbeat from a node: refresh its last-seen time.
+
+    Returns:
+        bool: False if the tracker does not know the node (it must register again).
+    """
+    peer = _peer(ip, port)
+    with index_lock:
+        if peer not in nodes:
+            return False
+        _touch(peer)
+    pending_writes.put(("ANNOUNCE", peer, time.time()))
+    return True
+
+def _file_entry(info_hash, file_name, total_piece, magnet_link):
+    # Gọi khi đang giữ index_lock
+    entry = files.get(info_hash)
+    if entry is None:
+        entry = {
+            "info_hash": info_hash,
+            "file_name": file_name,
+            "magnet_link": magnet_link,
+            "total_piece": total_piece,
+            "peers": set(),
+            "bitfields": {},
+        }
+        files[info_hash] = entry
+        by_name.setdefault(file_name, set()).add(info_hash)
+    return entry
+
+def _link_file(peer, info_hash, file_name, total_piece, magnet_link):
+    # Gọi khi đang giữ index_lock
+    entry = _file_entry(info_hash, file_name, total_piece, magnet_link)
+    if peer not in entry["peers"] or peer in entry["bitfields"]:
+        _invalidate(info_hash)
+    entry["peers"].add(peer)
+    entry["bitfields"].pop(peer, None)     # Đã có cả file, không cần bitfield nữa
+    nodes[peer].add(info_hash)
+
+def add_file(file_name, total_piece, magnet_link, ip, port):
+    """
+    Returns:
+        str: Message sent back to the node.
+    """
+    peer = _peer(ip, port)
+    info_hash = info_hash_of(magnet_link)
+    with index_lock:
+        if peer not in nodes:
+            return "Node not found."
+        _touch(peer)
+        _link_file(peer, info_hash, file_name, total_piece, magnet_link)
+    pending_writes.put(("REGISTER_FILE", peer, file_name, total_piece, magnet_link, info_hash))
+    return "File registered and added to the node!"
+
+def check_file_list(file_list):
+    """
+    Raise ValueError unless the decoded REGISTER_FILES body is a list of
+    [file_name, total_piece, magnet_link] entries.
+    """
+    if not isinstance(file_list, list) or not all(
+            isinstance(entry, list) and len(entry) == 3 and isinstance(entry[0], str) and isinstance(entry[2], str)
+            for entry in file_list):
+        raise ValueError("REGISTER_FILES expects a list of [file_name, total_piece, magnet_link]")
+
+def check_transfers(transfers):
+    """
+    Raise ValueError unless the decoded REPORT_TRANSFERS body is a list of
+    [upload_ip, upload_port, info_hash, piece_index, bytes] rows.
+    """
+    if not isinstance(transfers, list) or not all(
+            isinstance(row, list) and len(row) == 5 and isinstance(row[2], str)
+            and all(isinstance(row[i], int) for i in (1, 3, 4)) for row in transfers):
+        raise ValueError("REPORT_TRANSFERS expects a list of [upload_ip, upload_port, info_hash, piece_index, bytes]")
+
+def add_files(ip, port, file_list):
+    """
+    Register many files of one node at once (REGISTER_FILES).
+
+    Args:
+        file_list (list): [file_name, total_piece, magnet_link] entries.
+
+    Returns:
+        dict: {"registered": <count>, "message": <text>} sent back to the node.
+
+    Raises:
+        ValueError: file_list is not a list of [str, int, str] entries.
+    """
+    peer = _peer(ip, port)
+    check_file_list(file_list)
+    registered = [(file_name, int(total_piece), magnet_link, info_hash_of(magnet_link))
+                  for file_name, total_piece, magnet_link in file_list]
+    with index_lock:
+        if peer not in nodes:
+            return {"registered": 0, "message": "Node not found."}
+        _touch(peer)
+        for file_name, total_piece, magnet_link, info_hash in registered:
+            _link_file(peer, info_hash, file_name, total_piece, magnet_link)
+
+    # Cả batch là một thao tác -> một lần executemany trong transaction của writer
+    pending_writes.put(("REGISTER_FILES", peer, registered))
+    return {"registered": len(registered), "message": f"{len(registered)} files registered and added to the node!"}
+
+def have_pieces(ip, port, key, bitfield):
+    """
+    Record the pieces a node holds of a file it is still downloading (HAVE_PIECES).
+    The node joins the swarm as a partial peer; FIND_FILE returns its bitfield so
+    downloaders only ask it for pieces it really has.
+
+    An empty (all zero) bitfield withdraws the node from the swarm of that file.
+
+    Args:
+        key (str): info_hash of the file (file name and magnet link are accepted too).
+
+    Returns:
+        str: Message sent back to the node.
+    """
+    peer = _peer(ip, port)
+    with index_lock:
+        if peer not in nodes:
+            return "Node not found."
+        entry = _resolve(key)
+        if entry is None:
+            return f"File {key} not found."
+        info_hash = entry["info_hash"]
+        _touch(peer)
+
+        if peer in entry["peers"] and peer not in entry["bitfields"]:
+            return "OK"     # Node đã có cả file
+
+        bitfield = bytes(bitfield[:(entry["total_piece"] + 7) // 8])
+        if not any(bitfield):
+            # Bitfield rỗng: node đã bỏ file đang tải dở (tải lỗi/hỏng), rút lại các piece đã báo
+            if entry["bitfields"].pop(peer, None) is None:
+                return "OK"
+            entry["peers"].discard(peer)
+            nodes[peer].discard(info_hash)
+            _invalidate(info_hash)
+            pending_writes.put(("DROP_PIECES", peer, info_hash))
+            return "OK"
+
+        old = entry["bitfields"].get(peer, b"")
+        # Chỉ ghi xuống DB các piece mới so với lần báo trước
+        new_pieces = [index for index in proto.bitfield_indices(bitfield) if not proto.has_piece(old, index)]
+
+        if entry["bitfields"].get(peer) != bitfield:
+            _invalidate(info_hash)
+        entry["bitfields"][peer] = bitfield
+        entry["peers"].add(peer)
+        nodes[peer].add(info_hash)
+
+    if new_pieces:
+        pending_writes.put(("HAVE_PIECES", peer, info_hash, new_pieces))
+    return "OK"
+
+def record_transfers(ip, port, transfers):
+    """
+    Queue piece transfers reported by the downloading node (ip, port) for the
+    Transactions table. They do not change the swarm, only the DB.
+
+    Args:
+        transfers (list): [upload_ip, upload_port, info_hash, piece_index, bytes] rows.
+
+    Returns:
+        int: Number of rows queued.
+
+    Raises:
+        ValueError: transfers is not a list of 5-item rows.
+    """
+    check_transfers(transfers)
+    rows = [(str(upload_ip), int(upload_port), str(info_hash), int(index), int(size))
+            for upload_ip, upload_port, info_hash, index, size in transfers]
+    if rows:
+        pending_writes.put(("TRANSFERS", _peer(ip, port), rows))
+    return len(rows)
+
+def remove_node(ip, port):
+    peer = _peer(ip, port)
+    with index_lock:
+        held = nodes.pop(peer, None)
+        last_seen.pop(peer, None)
+        unverified.discard(peer)
+        scheduled.pop(peer, None)   # Entry trong heap thành entry cũ, bị bỏ qua khi pop
+        if held is None:
+            print(f"Node with IP {ip} and port {port} does not exist.")
+            return
+        for info_hash in held:
+            files[info_hash]["peers"].discard(peer)
+            files[info_hash]["bitfields"].pop(peer, None)
+            _invalidate(info_hash)
+    pending_writes.put(("REMOVE_NODE", peer))
+
+def expire_stale(now=None):
+    """
+    Drop every node that has not announced for PEER_TTL seconds.
+
+    Each sweep only pops the deadlines that are due instead of scanning every node.
+    A node that announced since its deadline was scheduled is pushed back with a
+    new deadline; entries of removed nodes no longer match `scheduled` and are
+    dropped.
+
+    Returns:
+        list: (ip, port) of the nodes that were removed.
+    """
+    now = time.monotonic() if now is None else now
+    expired = []
+    with index_lock:
+        while expiry_heap and expiry_heap[0][0] <= now:
+            deadline, peer = heapq.heappop(expiry_heap)
+            if scheduled.get(peer) != deadline:
+                continue
+            if _is_alive(peer, now):
+                scheduled[peer] = last_seen[peer] + PEER_TTL
+                heapq.heappush(expiry_heap, (scheduled[peer], peer))
+            else:
+                del scheduled[peer]
+                expired.append(peer)
+        for peer in expired:
+            remove_node(*peer)
+    for ip, port in expired:
+        print(f"Node {ip}:{port} expired (no announce for {PEER_TTL}s).")
+    return expired
+
+
+def load_from_db():
+    """
+    Rebuild the index from tracker.db for a warm restart (--persistent).
+
+    Every node found in the database is marked unverified: it keeps its files so
+    it does not have to re-register them, but it is not handed out to downloaders
+    until it announces again, and it expires after PEER_TTL if it never does.
+    """
+    node_rows, file_rows, link_rows, piece_rows = db.load_swarm()
+
+    with index_lock:
+        reply_cache.clear()
+        now = time.monotonic()
+        for ip, port in node_rows:
+            peer = _peer(ip, port)
+            nodes.setdefault(peer, set())
+            _touch(peer, now)
+            unverified.add(peer)
+
+        for file_name, total_piece, magnet_link, info_hash in file_rows:
+            _file_entry(info_hash, file_name, total_piece, magnet_link)
+
+        for ip, port, info_hash in link_rows:
+            _link_file(_peer(ip, port), info_hash, None, None, None)
+
+        # Piece của các node đang tải dở -> dựng lại bitfield
+        partial = {}
+        for ip, port, info_hash, piece_index in piece_rows:
+            partial.setdefault((_peer(ip, port), info_hash), []).append(piece_index)
+        for (peer, info_hash), piece_indices in partial.items():
+            entry = files[info_hash]
+            if peer in entry["peers"]:
+                continue    # Đã có cả file
+            entry["bitfields"][peer] = proto.make_bitfield(piece_indices, entry["total_piece"])
+            entry["peers"].add(peer)
+            nodes[peer].add(info_hash)
+
+    print(f"Loaded {len(node_rows)} nodes and {len(file_rows)} files from the database (unverified until they announce).")
+
+
+'''
+Lookups
+'''
+def lookup(key, numwant=None):
+    """
+    Find the swarm of a file by info_hash, magnet link or name.
+
+    Args:
+        key (str): info_hash (one dict lookup), magnet link, or file name. A name
+            shared by several files resolves to the swarm with the most peers.
+        numwant (int): Maximum number of peers to return (default NUMWANT,
+            capped at MAX_NUMWANT). Large swarms are sampled at random and the
+            list is always shuffled, so downloaders do not all start on the
+            same seeders.
+
+    Returns:
+        dict: {"nodes": [[ip, port], ...], "file_name", "info_hash", "magnet_link", "total_piece",
+        "bitfields": {"ip:port": base64 bitfield}} where "bitfields" only lists
+        the returned peers that hold part of the file; or None if the file is
+        unknown or nobody holds it anymore.
+    """
+    with index_lock:
+        entry = _resolve(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        alive = [list(peer) for peer in entry["peers"] if _is_alive(peer, now) and peer not in unverified]
+        if not alive:
+            return None
+
+        numwant = min(numwant or NUMWANT, MAX_NUMWANT)
+        if len(alive) > numwant:
+            alive = random.sample(alive, numwant)
+        else:
+            random.shuffle(alive)
+
+        bitfields = {}
+        for ip, port in alive:
+            bitfield = entry["bitfields"].get((ip, port))
+            if bitfield is not None:
+                bitfields[f"{ip}:{port}"] = proto.encode_bitfield(bitfield)
+        return {
+            "nodes": alive,
+            "file_name": entry["file_name"],
+            "info_hash": entry["info_hash"],
+            "magnet_link": entry["magnet_link"],
+            "total_piece": entry["total_piece"],
+            "bitfields": bitfields,
+        }
+
+def sizes():
+    """
+    Current size of the index, reported by STATS.
+    """
+    with index_lock:
+        return {
+            "nodes": len(nodes),
+            "unverified_nodes": len(unverified),
+            "files": len(files),
+            "peers": sum(len(entry["peers"]) for entry in files.values()),
+            "partial_peers": sum(len(entry["bitfields"]) for entry in files.values()),
+            "pending_writes": pending_writes.qsize(),
+            "cached_files": len(reply_cache),
+            "cache_hits": cache_hits,
+            "cache_misses": cache_misses,
+        }
+
+def find_reply(key, numwant=None, compact=False):
+    """
+    Encoded FIND_FILE reply frame for `key`, served from reply_cache when possible.
+
+    Up to CACHE_VARIANTS replies, each with its own random sample/order of peers,
+    are kept per (file, numwant, compact); a hit returns one of them at random, so
+    downloaders are still spread over the seeders. The frame is encoded outside
+    index_lock and only stored if the swarm was not invalidated in the meantime.
+
+    Returns:
+        bytes: The frame to send, or None if the file is unknown or nobody holds it.
+    """
+    global cache_hits, cache_misses
+    numwant = min(numwant or NUMWANT, MAX_NUMWANT)
+
+    with index_lock:
+        entry = _resolve(key)
+        if entry is None:
+            return None
+        info_hash = entry["info_hash"]
+
+        cached = reply_cache.get(info_hash)
+        if cached is None:
+            if len(reply_cache) >= CACHE_MAX_FILES:
+                reply_cache.pop(next(iter(reply_cache)))
+            cached = reply_cache[info_hash] = {}
+        variants = cached.setdefault((numwant, compact), [])
+        if len(variants) >= CACHE_VARIANTS:
+            cache_hits += 1
+            return random.choice(variants)
+
+        cache_misses += 1
+        response = lookup(info_hash, numwant)
+
+    if response is None:
+        return None
+    frame = proto.find_reply_frame(response, compact)
+    with index_lock:
+        if reply_cache.get(info_hash) is cached and len(variants) < CACHE_VARIANTS:
+            variants.append(frame)
+    return frame
+
+def lookup_many(keys, numwant=None):
+    """
+    Batch version of lookup() for FIND_FILES.
+
+    Returns:
+        dict: key -> result of lookup(key, numwant) (None for unknown files).
+    """
+    with index_lock:
+        return {key: lookup(key, numwant) for key in keys}
+
+
+'''
+Write-behind
+'''
+def _drain(block):
+    ops = []
+    try:
+        ops.append(pending_writes.get(block=block, timeout=WRITE_INTERVAL))
+        while len(ops) < MAX_BATCH:
+            ops.append(pending_writes.get_nowait())
+    except queue.Empty:
+        pass
+    return ops
+
+def _writer_loop():
+    try:
+        while not writer_stop.is_set():
+            ops = _drain(block=True)
+            if ops:
+                db.apply_batch(ops)
+    finally:
+        db.close_db()
+
+def start_writer():
+    global writer_thread
+    writer_thread = Thread(target=_writer_loop, daemon=True, name="swarm-writer")
+    writer_thread.start()
+
+def _sweeper_loop():
+    try:
+        while not writer_stop.wait(SWEEP_INTERVAL):
+            expire_stale()
+    finally:
+        db.close_db()
+
+def start_sweeper():
+    global sweeper_thread
+    sweeper_thread = Thread(target=_sweeper_loop, daemon=True, name="swarm-sweeper")
+    sweeper_thread.start()
+
+def flush():
+    """
+    Stop the writer and persist whatever is still queued. Called on shutdown.
+    """
+    writer_stop.set()
+    if writer_thread:
+        writer_thread.join(timeout=WRITE_INTERVAL * 4)
+    while True:
+        ops = _drain(block=False)
+        if not ops:
+            break
+        db.apply_batch(ops)
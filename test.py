@@ -1,6 +1,10 @@
 import hashlib
+import os
+import tempfile
 import urllib.parse
 
+import file_transfer
+
 def generate_magnet_link(file_name, pieces_metadata):
     """
     Generates a magnet link for a file based on its metadata.
@@ -41,6 +45,34 @@ def decode_magnet_link(magnet_link):
 
     return {"info_hash": info_hash, "file_name": file_name}
 
+def check_empty_partial_file():
+    """
+    A 0-piece download preallocates nothing and commits to a 0-byte file.
+    """
+    with tempfile.TemporaryDirectory() as save_path:
+        partial = file_transfer.PartialFile(save_path, "empty.bin", 0, file_transfer.PIECESIZE)
+        partial.commit()
+        assert os.path.getsize(os.path.join(save_path, "empty.bin")) == 0
+        assert not os.path.exists(os.path.join(save_path, "empty.bin.partial"))
+
+def check_partial_file_in_use():
+    """
+    A second download of a file already being downloaded is refused and leaves
+    the first one's .partial untouched.
+    """
+    with tempfile.TemporaryDirectory() as save_path:
+        first = file_transfer.PartialFile(save_path, "a.bin", 2, 4)
+        first.write(0, b"abcd")
+        try:
+            file_transfer.PartialFile(save_path, "a.bin", 2, 4)
+        except FileExistsError:
+            pass
+        else:
+            raise AssertionError("second PartialFile for a.bin was not refused")
+        assert first.read(0) == b"abcd"
+        first.discard()
+        file_transfer.PartialFile(save_path, "a.bin", 2, 4).discard()   # Tên đã được nhả
+
 if __name__ == "__main__":
     metadata = [
         {
@@ -67,4 +99,6 @@ if __name__ == "__main__":
 
     magnet = generate_magnet_link("example_file.txt", metadata)
     hashed = decode_magnet_link(magnet)
-    
\ No newline at end of file
+
+    check_empty_partial_file()
+    check_partial_file_in_use()
@@ -0,0 +1,233 @@
+import hashlib
+import os
+import random
+import socket
+import struct
+import time
+from threading import Thread
+
+'''
+UDP endpoint của tracker, theo kiểu BitTorrent UDP tracker (BEP 15).
+
+ANNOUNCE (heartbeat) và LOOKUP (FIND_FILE theo info_hash) chỉ tốn một cặp
+datagram thay vì một TCP handshake. Đăng ký node/file vẫn đi qua TCP.
+
+Mọi request (trừ CONNECT) mang connection_id nhận được từ CONNECT, chống giả
+mạo địa chỉ nguồn. connection_id = hash(secret, địa chỉ client, phút hiện tại)
+nên tracker không phải lưu gì; id hợp lệ trong khoảng 1-2 phút.
+
+    CONNECT  req: protocol_id (8) | action=0 (4) | transaction_id (4)
+             res: action=0 (4) | transaction_id (4) | connection_id (8)
+    ANNOUNCE req: connection_id (8) | action=1 (4) | transaction_id (4) | node ip (4) | node port (2)
+             res: action=1 (4) | transaction_id (4) | interval (4)
+    LOOKUP   req: connection_id (8) | action=2 (4) | transaction_id (4) | info_hash (20) | numwant (4)
+             res: action=2 (4) | transaction_id (4) | total_piece (4) | count (4) | count * (ip (4) | port (2))
+    ERROR    res: action=3 (4) | transaction_id (4) | message (utf-8)
+
+node ip = 0.0.0.0 nghĩa là lấy IP nguồn của datagram. LOOKUP chỉ trả peer IPv4.
+'''
+
+PROTOCOL_ID = 0x41727101980     # Hằng số magic của BEP 15
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_LOOKUP = 2
+ACTION_ERROR = 3
+
+CONNECT_REQUEST = struct.Struct("!QII")
+CONNECT_RESPONSE = struct.Struct("!IIQ")
+REQUEST_HEADER = struct.Struct("!QII")
+ANNOUNCE_REQUEST = struct.Struct("!QII4sH")
+ANNOUNCE_RESPONSE = struct.Struct("!III")
+LOOKUP_REQUEST = struct.Struct("!QII20sI")
+LOOKUP_RESPONSE = struct.Struct("!IIII")
+RESPONSE_HEADER = struct.Struct("!II")
+PEER4 = struct.Struct("!4sH")
+
+CONNECTION_ID_LIFETIME = 60     # Giây; id của phút trước vẫn được chấp nhận
+MAX_DATAGRAM = 2048
+ANNOUNCE_INTERVAL = 30          # Giây, gợi ý cho node trong reply ANNOUNCE
+REQUEST_TIMEOUT = 1.0           # Giây chờ reply phía client trước khi gửi lại
+RETRIES = 3
+
+_secret = os.urandom(16)
+
+
+def connection_id_for(addr, bucket=None):
+    bucket = int(time.time() // CONNECTION_ID_LIFETIME) if bucket is None else bucket
+    digest = hashlib.sha1(_secret + f"{addr[0]}:{addr[1]}:{bucket}".encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+def valid_connection_id(connection_id, addr):
+    bucket = int(time.time() // CONNECTION_ID_LIFETIME)
+    return connection_id in (connection_id_for(addr, bucket), connection_id_for(addr, bucket - 1))
+
+def _error(transaction_id, message):
+    return RESPONSE_HEADER.pack(ACTION_ERROR, transaction_id) + message.encode('utf-8')
+
+
+'''
+Server
+'''
+def handle_datagram(data, addr, announce, lookup):
+    """
+    Build the reply to one datagram.
+
+    Args:
+        data (bytes): The request.
+        addr (tuple): (ip, port) it came from.
+        announce (callable): announce(ip, port) -> bool, False if the node is unknown.
+        lookup (callable): lookup(info_hash hex, numwant) -> swarm dict or None.
+
+    Returns:
+        bytes: The reply, or None to drop the datagram.
+    """
+    if len(data) < REQUEST_HEADER.size:
+        return None
+    connection_id, action, transaction_id = REQUEST_HEADER.unpack_from(data)
+
+    if action == ACTION_CONNECT:
+        if connection_id != PROTOCOL_ID:
+            return None
+        return CONNECT_RESPONSE.pack(ACTION_CONNECT, transaction_id, connection_id_for(addr))
+
+    if not valid_connection_id(connection_id, addr):
+        return _error(transaction_id, "Invalid connection id.")
+
+    if action == ACTION_ANNOUNCE and len(data) >= ANNOUNCE_REQUEST.size:
+        _, _, _, node_ip, node_port = ANNOUNCE_REQUEST.unpack_from(data)
+        node_ip = addr[0] if node_ip == bytes(4) else socket.inet_ntoa(node_ip)
+        if not announce(node_ip, node_port):
+            return _error(transaction_id, "Unknown node.")
+        return ANNOUNCE_RESPONSE.pack(ACTION_ANNOUNCE, transaction_id, ANNOUNCE_INTERVAL)
+
+    if action == ACTION_LOOKUP and len(data) >= LOOKUP_REQUEST.size:
+        _, _, _, info_hash, numwant = LOOKUP_REQUEST.unpack_from(data)
+        swarm_info = lookup(info_hash.hex(), numwant)
+        if not swarm_info:
+            return _error(transaction_id, f"File {info_hash.hex()} not found.")
+        peers = []
+        for ip, port in swarm_info["nodes"]:
+            try:
+                peers.append(PEER4.pack(socket.inet_aton(ip), port))
+            except OSError:
+                pass    # Không phải IPv4
+        return LOOKUP_RESPONSE.pack(ACTION_LOOKUP, transaction_id, swarm_info["total_piece"], len(peers)) + b"".join(peers)
+
+    return _error(transaction_id, "Unknown action.")
+
+def _serve(server_socket, announce, lookup):
+    buffer = bytearray(MAX_DATAGRAM)
+    while True:
+        try:
+            size, addr = server_socket.recvfrom_into(buffer)
+        except OSError:
+            break   # Socket đã bị đóng
+        try:
+            reply = handle_datagram(bytes(buffer[:size]), addr, announce, lookup)
+            if reply:
+                server_socket.sendto(reply, addr)
+        except Exception as e:
+            print(f"Error in UDP tracker handling datagram from {addr}: {e}")
+
+def start_server(host, port, announce, lookup, reuse_port=False):
+    """
+    Serve the UDP tracker protocol on host:port in a daemon thread.
+
+    Returns:
+        socket: The UDP socket (close it to stop the server).
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((host, port))
+    Thread(target=_serve, args=(server_socket, announce, lookup), daemon=True, name="udp-tracker").start()
+    print(f"UDP tracker listening on {host}:{port}")
+    return server_socket
+
+
+'''
+Client
+'''
+class TrackerError(Exception):
+    """Raised when the tracker answers with ACTION_ERROR."""
+
+
+class UdpTrackerClient:
+    """
+    Client side used by Node.py. Keeps the connection_id between calls and
+    asks for a new one when it is about to expire.
+    """
+
+    def __init__(self, tracker_ip, tracker_port):
+        self.address = (tracker_ip, tracker_port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(REQUEST_TIMEOUT)
+        self.connection_id = None
+        self.connected_at = 0
+
+    def _request(self, build, action):
+        """
+        Send build(transaction_id) and wait for the matching reply, resending
+        up to RETRIES times. Returns the reply bytes after the 8-byte header.
+        """
+        transaction_id = random.getrandbits(32)
+        request = build(transaction_id)
+        for _ in range(RETRIES):
+            self.sock.sendto(request, self.address)
+            try:
+                while True:
+                    reply = self.sock.recv(MAX_DATAGRAM)
+                    if len(reply) < RESPONSE_HEADER.size:
+                        continue
+                    reply_action, reply_transaction = RESPONSE_HEADER.unpack_from(reply)
+                    if reply_transaction != transaction_id:
+                        continue    # Reply muộn của request trước
+                    if reply_action == ACTION_ERROR:
+                        raise TrackerError(reply[RESPONSE_HEADER.size:].decode('utf-8'))
+                    if reply_action == action:
+                        return reply[RESPONSE_HEADER.size:]
+            except socket.timeout:
+                continue
+        raise TimeoutError(f"No reply from UDP tracker {self.address[0]}:{self.address[1]}")
+
+    def connect(self):
+        payload = self._request(lambda tid: CONNECT_REQUEST.pack(PROTOCOL_ID, ACTION_CONNECT, tid), ACTION_CONNECT)
+        (self.connection_id,) = struct.unpack("!Q", payload[:8])
+        self.connected_at = time.monotonic()
+
+    def _ensure_connected(self):
+        if self.connection_id is None or time.monotonic() - self.connected_at > CONNECTION_ID_LIFETIME:
+            self.connect()
+
+    def announce(self, node_ip, node_port):
+        """
+        Returns:
+            int: Announce interval suggested by the tracker.
+        Raises:
+            TrackerError: e.g. "Unknown node." if the node must register again over TCP.
+        """
+        self._ensure_connected()
+        ip = socket.inet_aton(node_ip) if node_ip else bytes(4)
+        payload = self._request(
+            lambda tid: ANNOUNCE_REQUEST.pack(self.connection_id, ACTION_ANNOUNCE, tid, ip, node_port),
+            ACTION_ANNOUNCE)
+        return struct.unpack("!I", payload[:4])[0]
+
+    def lookup(self, info_hash, numwant=50):
+        """
+        Returns:
+            dict: {"nodes": [[ip, port], ...], "total_piece"} of the swarm.
+        Raises:
+            TrackerError: If nobody has the file.
+        """
+        self._ensure_connected()
+        payload = self._request(
+            lambda tid: LOOKUP_REQUEST.pack(self.connection_id, ACTION_LOOKUP, tid, bytes.fromhex(info_hash), numwant),
+            ACTION_LOOKUP)
+        total_piece, count = struct.unpack("!II", payload[:8])
+        nodes = [[socket.inet_ntoa(ip), port]
+                 for ip, port in PEER4.iter_unpack(payload[8:8 + count * PEER4.size])]
+        return {"nodes": nodes, "total_piece": total_piece}
+
+    def close(self):
+        self.sock.close()